@@ -1,24 +1,54 @@
 import os
 import logging
 import uuid
+import hashlib
 import datetime
 import json
 import re
 from dotenv import load_dotenv
 import time
+from collections import Counter, OrderedDict
+from functools import lru_cache
+
+try:
+    import ahocorasick
+except ImportError:  # pyahocorasick is optional, fall back to substring checks
+    ahocorasick = None
 
 # Load environment variables from .env file
 load_dotenv()
 
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, g
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, g, Response, stream_with_context
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "admission-consultant-secret-key")
 
+# Server-side sessions in Redis: the cookie only carries a session id instead of
+# the whole chat history. Without REDIS_URL the signed cookie session is used.
+REDIS_URL = os.environ.get("REDIS_URL")
+redis_client = None
+if REDIS_URL:
+    import redis
+    from flask_session import Session
+    redis_client = redis.Redis.from_url(REDIS_URL)
+    app.config.update(SESSION_TYPE='redis', SESSION_REDIS=redis_client)
+    Session(app)
+
+
+# Markdown code fence markers (```html and ```) stripped from responses
+_FENCE_RE = re.compile(r'```(?:html)?')
+
+# Tags checked for missing closing tags, in the order closers are appended
+COMMON_TAGS = ('div', 'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ul', 'ol', 'li', 'span', 'strong', 'b', 'i', 'em', 'small')
+
+
+# Opening or closing tag of one of COMMON_TAGS; group 1 is "/" for closing tags
+_BALANCE_TAG_RE = re.compile(r'<(/?)(' + '|'.join(COMMON_TAGS) + r')\b', re.IGNORECASE)
+
 
 # Helper function to clean HTML responses
 def clean_html_response(text):
@@ -27,43 +57,141 @@ def clean_html_response(text):
         return ""
     
     # Remove Markdown code block markers
-    text = re.sub(r'```html', '', text)
-    text = re.sub(r'```', '', text)
+    text = _FENCE_RE.sub('', text)
     
     # Make sure HTML tags are properly formatted
     # Convert &lt; to < and &gt; to > if they exist
     text = text.replace('&lt;', '<').replace('&gt;', '>').replace('&amp;', '&')
     
-    # Make sure all HTML tags are properly closed
-    # This is a simple check and won't catch all issues
-    common_tags = ['div', 'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ul', 'ol', 'li', 'span', 'strong', 'b', 'i', 'em', 'small']
-    for tag in common_tags:
-        # Count opening and closing tags
-        open_count = text.count(f'<{tag}')
-        close_count = text.count(f'</{tag}')
-        
-        # If there are more opening tags than closing tags, add closing tags
-        if open_count > close_count:
-            text += f'</{tag}>' * (open_count - close_count)
+    # Make sure all HTML tags are properly closed: count opening minus closing tags in one sweep
+    balance = Counter()
+    for match in _BALANCE_TAG_RE.finditer(text):
+        balance[match.group(2).lower()] += -1 if match.group(1) else 1
+    
+    # If there are more opening tags than closing tags, add closing tags
+    missing_closers = [f'</{tag}>' * balance[tag] for tag in COMMON_TAGS if balance[tag] > 0]
+    if missing_closers:
+        text += ''.join(missing_closers)
     
-    logger.debug(f"Cleaned HTML response. First 100 chars: {text[:100]}")
+    logger.debug("Cleaned HTML response. First 100 chars: %.100s", text)
     return text
     
+# File name keywords for each category, checked in order; the first match wins
+_CATEGORY_KEYWORDS = (
+    ('diem_chuan', ('diem', 'chuan')),
+    ('hoc_phi', ('hoc_phi', 'phi')),
+    ('nganh_hoc', ('nganh', 'khoa')),
+    ('co_so', ('co_so', 'vat_chat')),
+    ('tuyen_sinh', ('tuyen_sinh', 'tuyen')),
+)
+
+# Prioritization hint header for each category, in the order they appear in the context
+_CATEGORY_HINTS = (
+    ('diem_chuan', "FILES ABOUT ĐIỂM CHUẨN (PRIORITY FOR QUESTIONS ABOUT ADMISSION SCORES): "),
+    ('hoc_phi', "FILES ABOUT HỌC PHÍ (PRIORITY FOR QUESTIONS ABOUT TUITION FEES): "),
+    ('nganh_hoc', "FILES ABOUT NGÀNH HỌC (PRIORITY FOR QUESTIONS ABOUT MAJORS/DEPARTMENTS): "),
+    ('co_so', "FILES ABOUT CƠ SỞ VẬT CHẤT (PRIORITY FOR QUESTIONS ABOUT FACILITIES): "),
+    ('tuyen_sinh', "FILES ABOUT TUYỂN SINH (PRIORITY FOR QUESTIONS ABOUT ADMISSIONS): "),
+    ('other', "OTHER FILES: "),
+)
+
+# One alternation over every category keyword; a keyword maps to (priority, category)
+_CATEGORY_BY_KEYWORD = {
+    keyword: (priority, category)
+    for priority, (category, keywords) in enumerate(_CATEGORY_KEYWORDS)
+    for keyword in keywords
+}
+_CATEGORY_RE = re.compile('|'.join(sorted(map(re.escape, _CATEGORY_BY_KEYWORD), key=len, reverse=True)))
+
+@lru_cache(maxsize=256)
+def categorize_filename(filename):
+    """Return the category of a source file based on keywords in its name"""
+    matches = _CATEGORY_RE.findall(filename.lower())
+    if not matches:
+        return 'other'
+    # Keep the first-listed category among the matched keywords
+    return min(_CATEGORY_BY_KEYWORD[keyword] for keyword in matches)[1]
+
+@lru_cache(maxsize=512)
+def build_source_info(readable_sources):
+    """
+    Build the source file and prioritization hint block appended to the context.
+    Cached, since follow-up questions usually retrieve the same files.
+    
+    Args:
+        readable_sources (tuple): Source filenames, in retrieval order
+    """
+    # Group files by type to help with prioritization hints
+    file_categories = {category: [] for category, _ in _CATEGORY_HINTS}
+    for filename in readable_sources:
+        file_categories[categorize_filename(filename)].append(filename)
+    
+    # Add metadata about files and prioritization hints
+    lines = [
+        "\n\n### SOURCE FILES AND PRIORITIZATION HINTS:",
+        "THIS INFORMATION IS FOUND IN THE FOLLOWING FILES: " + ", ".join(readable_sources) + "\n",
+    ]
+    # Add hints about file categories to help API prioritize correctly
+    lines.extend(
+        header + ", ".join(file_categories[category])
+        for category, header in _CATEGORY_HINTS
+        if file_categories[category]
+    )
+    return "\n".join(lines)
+
+def readable_source_name(file_id):
+    """Original filename of a source file id, without any UUID upload prefix"""
+    if file_id in file_information:
+        # Use the original filename stored during upload
+        return file_information[file_id]
+    # For files with UUID prefixes ("<uuid>_<name>"), extract the original name
+    if '_' in file_id and '-' in file_id:
+        return file_id.split('_', 1)[1]
+    return file_id
+
+# Accent-folded admission keywords; short queries without any of them skip retrieval
+_ADMISSION_KEYWORDS = frozenset({
+    'diem', 'chuan', 'hoc', 'phi', 'nganh', 'tuyen', 'sinh', 'co', 'so',
+    # The school itself, its campus and how to contact it
+    'truong', 'dai', 'ou', 'dia', 'chi', 'lien', 'he', 'hotline', 'email', 'website',
+})
+MAX_SMALL_TALK_TOKENS = 3
+
+def is_small_talk(query):
+    """True for very short queries that mention no admission topic"""
+    tokens = re.findall(r'\w+', fold_vietnamese(query))
+    return len(tokens) <= MAX_SMALL_TALK_TOKENS and not (_ADMISSION_KEYWORDS & set(tokens))
+
+# Retrieval settings for the chat endpoint
+SEARCH_TOP_K = 5
+SEARCH_THRESHOLD = 0.25
+
 # PDF files are pre-loaded from the upload folder
 UPLOAD_FOLDER = 'uploads'
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
 # Import utilities after app is created
-from utils.pdf_processor import extract_text_from_pdf, chunk_text
+from utils.pdf_processor import extract_and_chunk_pdf, split_source_tag
 from utils.vector_store_transformers import TransformerVectorStore
 from utils.vector_store_tfidf import VectorStore
-from utils.gemini_api import generate_response
-from utils.orchestrator import orchestrate_response
-from utils.conversation_handler import ConversationHandler
+from utils.gemini_api import generate_response, generate_small_talk_response
+from utils.orchestrator import orchestrate_response, orchestrate_response_stream, STREAM_RESET
+from utils.conversation_handler import ConversationHandler, fold_vietnamese
+from utils.embedding_cache import SemanticCache, normalize_query
 import asyncio
+import atexit
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+
+# Persistent event loop in a background thread, shared by all requests so that
+# async resources created by the orchestrator survive between requests
+ORCHESTRATOR_TIMEOUT = 120  # seconds
+_event_loop = asyncio.new_event_loop()
+threading.Thread(target=_event_loop.run_forever, name="orchestrator-loop", daemon=True).start()
 
-# Dictionary to store file information: key = file_id, value = {filename, content} 
+# Dictionary to store file information: key = file_id, value = original filename 
 file_information = {}
 
 # vector_store = VectorStore()
@@ -74,6 +202,58 @@ vector_store = TransformerVectorStore()
 conversation_handler = ConversationHandler()
 logger.info("Initialized conversation handler for conversational queries")
 
+@lru_cache(maxsize=2048)
+def classify_conversational_query(normalized_query):
+    """Cached conversational classification; the response itself is still picked at random"""
+    return conversation_handler.classify_query(normalized_query)
+
+# Semantic cache of generated responses, keyed by query embeddings
+QUERY_CACHE_PATH = "vector_store_data/query_cache.pkl"
+response_cache = SemanticCache(threshold=0.95, maxsize=512)
+try:
+    if response_cache.load_from_disk(QUERY_CACHE_PATH):
+        logger.info(f"Loaded {len(response_cache.entries)} cached responses from {QUERY_CACHE_PATH}")
+except Exception as e:
+    logger.error(f"Failed to load query cache from disk: {e}")
+
+def save_response_cache():
+    try:
+        response_cache.save_to_disk(QUERY_CACHE_PATH)
+    except Exception as e:
+        logger.error(f"Failed to save query cache to disk: {e}")
+
+atexit.register(save_response_cache)
+
+def invalidate_response_cache():
+    """Drop cached answers, in memory and on disk, once the indexed documents change"""
+    response_cache.clear()
+    try:
+        os.remove(QUERY_CACHE_PATH)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.error(f"Failed to remove query cache file: {e}")
+
+# [mtime_ns, size] fingerprints of the PDFs already in the vector store, for incremental re-indexing
+PDF_INDEX_PATH = "vector_store_data/index.json"
+
+def load_pdf_index():
+    try:
+        with open(PDF_INDEX_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_pdf_index(pdf_index):
+    try:
+        os.makedirs(os.path.dirname(PDF_INDEX_PATH), exist_ok=True)
+        tmp_path = f"{PDF_INDEX_PATH}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(pdf_index, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, PDF_INDEX_PATH)
+    except OSError as e:
+        logger.error(f"Failed to save PDF index: {e}")
+
 # Function to load documents from uploaded PDFs
 def load_existing_documents():
     if not os.path.exists(UPLOAD_FOLDER):
@@ -83,69 +263,284 @@ def load_existing_documents():
     # vector_store_path = "vector_store_data/tfidf_store.pkl"
     vector_store_path = "vector_store_data/transformer_store.pkl"
     
+    # scandir caches each entry's stat, so fingerprinting the PDFs costs no extra syscalls
+    with os.scandir(UPLOAD_FOLDER) as it:
+        pdf_fingerprints = {
+            entry.name: [entry.stat().st_mtime_ns, entry.stat().st_size]
+            for entry in it if entry.is_file() and entry.name.endswith('.pdf')
+        }
+    logger.info(f"Found {len(pdf_fingerprints)} PDF files in uploads folder")
+    
+    loaded = False
     if os.path.exists(vector_store_path):
         try:
             if vector_store.load_from_disk(vector_store_path):
                 logger.info(f"Loaded vector store from {vector_store_path}")
-                return
+                loaded = True
         except Exception as e:
             logger.error(f"Failed to load vector store from disk: {e}")
             logger.info("Falling back to rebuilding vector store from PDF files")
-
-    # Nếu không có pickle hoặc lỗi, thì build lại từ PDF
-        if not os.path.exists(UPLOAD_FOLDER):
-            return
-        
-    vector_store.clear()
+    
     global file_information
-    file_information = {}  # Reset file information dictionary
+    if loaded:
+        # Only re-index PDFs that are new or changed since the store was saved
+        pdf_index = load_pdf_index()
+        pdf_files = [
+            name for name, fingerprint in pdf_fingerprints.items()
+            if pdf_index.get(name) != fingerprint or name not in vector_store.file_indices
+        ]
+        removed_files = [name for name in vector_store.file_indices if name not in pdf_fingerprints]
+        if not pdf_files and not removed_files:
+            return
+        for name in pdf_files + removed_files:
+            vector_store.remove_file(name)
+        logger.info(f"Re-indexing {len(pdf_files)} new or modified PDFs, dropping {len(removed_files)} removed PDFs")
+    else:
+        # Nếu không có pickle hoặc lỗi, thì build lại từ PDF
+        vector_store.clear()
+        file_information = {}  # Reset file information dictionary
+        pdf_files = list(pdf_fingerprints)
     
-    pdf_files = [f for f in os.listdir(UPLOAD_FOLDER) if f.endswith('.pdf')]
-    logger.info(f"Found {len(pdf_files)} PDF files in uploads folder")
+    # Cached answers may quote documents that are about to change or disappear
+    invalidate_response_cache()
     
-    for pdf_file in pdf_files:
-        filepath = os.path.join(UPLOAD_FOLDER, pdf_file)
-        try:
-            # Extract text from PDF
-            text = extract_text_from_pdf(filepath)
-            
-            # Store file information for reference
-            file_id = pdf_file
-            file_information[file_id] = {
-                'filename': pdf_file,
-                'content': text
-            }
-            
-            # Chunk text for vector database and tag with source file
-            chunks = chunk_text(text, file_source=pdf_file)
-            
-            # Log sample of chunks to debug
-            if chunks:
-                # Get sample text (skip the source tag line for logging)
-                sample_chunk = chunks[0]
-                if sample_chunk.startswith("SOURCE_FILE:"):
-                    # Extract content after the source tag
-                    sample_lines = sample_chunk.split('\n', 1)
-                    if len(sample_lines) > 1:
-                        sample_chunk = sample_lines[1]
+    # Chunks from all PDFs are embedded together in one batched encode after the loop
+    all_chunks = []
+    all_sources = []
+    
+    # Extract and chunk PDFs in parallel; the vector store is only written from this thread.
+    # No more workers than PDFs, since incremental re-indexes often touch just one or two.
+    # Workers are spawned, not forked: this runs after torch and the event loop thread have
+    # started, and forking a multithreaded process can deadlock on their locks. Spawned
+    # workers only import utils.pdf_processor to unpickle extract_and_chunk_pdf.
+    max_workers = max(1, min(len(pdf_files), os.cpu_count() or 1))
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {
+            pdf_file: executor.submit(extract_and_chunk_pdf, os.path.join(UPLOAD_FOLDER, pdf_file))
+            for pdf_file in pdf_files
+        }
+        
+        for pdf_file, future in futures.items():
+            try:
+                chunks = future.result()
                 
-                logger.debug(f"Sample chunk from {pdf_file}: {sample_chunk[:200]}...")
-                logger.info(f"Extracted {len(chunks)} chunks from {pdf_file}")
-            
-            # Add chunks to vector store with source information
-            vector_store.add_documents(chunks, file_source=pdf_file)            
-            logger.info(f"Processed and loaded {pdf_file} into vector store")
-        except Exception as e:
-            logger.error(f"Error processing PDF {pdf_file}: {e}")
+                # Store file information for reference; the extracted text is not kept
+                file_information[pdf_file] = pdf_file
+                
+                # Log sample of chunks to debug
+                if chunks:
+                    # Get sample text (skip the source tag line for logging)
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("Sample chunk from %s: %.200s...", pdf_file, split_source_tag(chunks[0])[1])
+                    logger.info(f"Extracted {len(chunks)} chunks from {pdf_file}")
+                
+                # Queue chunks for the vector store with source information
+                all_chunks.extend(chunks)
+                all_sources.extend([pdf_file] * len(chunks))
+                logger.info(f"Processed {pdf_file}")
+            except Exception as e:
+                logger.error(f"Error processing PDF {pdf_file}: {e}")
+                # Not indexed, so it is retried on the next start
+                pdf_fingerprints.pop(pdf_file, None)
+    
+    vector_store.add_documents_batch(all_chunks, all_sources)
     try:
         os.makedirs("vector_store_data", exist_ok=True)
         vector_store.save_to_disk(vector_store_path)
         logger.info(f"Saved vector store to {vector_store_path}")
+        save_pdf_index(pdf_fingerprints)
     except Exception as e:
         logger.error(f"Failed to save vector store to disk: {e}")
         
-# Load existing documents on startup
-load_existing_documents()
+# Set once the vector store is ready; retrieval queries wait for it
+_READY = threading.Event()
+
+def warm_up_documents():
+    try:
+        load_existing_documents()
+    except Exception as e:
+        logger.error(f"Error loading documents on startup: {e}")
+    finally:
+        _READY.set()
+
+# Opt-in: share the embedding matrix with forked workers (run gunicorn with --preload).
+# The matrix must exist before the fork, so in this mode documents load synchronously.
+if os.environ.get("SHARE_VECTOR_STORE") == "1":
+    warm_up_documents()
+    if vector_store.share_vectors():
+        atexit.register(vector_store.release_shared_vectors)
+else:
+    # Load existing documents in the background so the server starts answering immediately
+    threading.Thread(target=warm_up_documents, name="document-warmup", daemon=True).start()
+
+MAX_CHAT_HISTORY = 20
+PREVIEW_LENGTH = 400  # Assistant messages longer than this are stored outside the session
+MESSAGE_TTL = 86400  # seconds
+_TAG_RE = re.compile(r'<[^>]+>')
+
+# Short-lived blobs (full assistant messages, finished streamed turns) live in Redis
+# when it is configured so every worker sees them, otherwise in this bounded map
+MAX_LOCAL_BLOBS = 2048
+_local_blobs = OrderedDict()
+_local_blobs_lock = threading.Lock()
+
+def put_blob(key, value, ttl):
+    if redis_client is not None:
+        redis_client.set(key, value.encode("utf-8"), ex=ttl)
+        return
+    with _local_blobs_lock:
+        _local_blobs[key] = value
+        _local_blobs.move_to_end(key)
+        while len(_local_blobs) > MAX_LOCAL_BLOBS:
+            _local_blobs.popitem(last=False)
+
+def get_blobs(keys):
+    """Return the stored values for keys, with None for missing ones"""
+    if not keys:
+        return []
+    if redis_client is not None:
+        return [value.decode("utf-8") if value is not None else None for value in redis_client.mget(keys)]
+    with _local_blobs_lock:
+        return [_local_blobs.get(key) for key in keys]
+
+def pop_blob(key):
+    if redis_client is not None:
+        pipe = redis_client.pipeline()
+        pipe.get(key)
+        pipe.delete(key)
+        value, _ = pipe.execute()
+        return value.decode("utf-8") if value is not None else None
+    with _local_blobs_lock:
+        return _local_blobs.pop(key, None)
+
+def message_fingerprint(role, content):
+    """Stable fingerprint of a chat message (Python's hash() is salted per process)"""
+    return hashlib.blake2b(f"{role}\x00{content}".encode("utf-8"), digest_size=8).hexdigest()
+
+def make_history_entry(role, content, fingerprint):
+    """
+    Build a chat history entry. Long assistant messages are stored as a blob under
+    their fingerprint and the session only keeps a plain-text preview.
+    """
+    if role != "assistant" or len(content) <= PREVIEW_LENGTH:
+        return {"role": role, "content": content}
+    put_blob(f"msg:{fingerprint}", content, MESSAGE_TTL)
+    preview = " ".join(_TAG_RE.sub(" ", content).split())[:PREVIEW_LENGTH]
+    return {"role": role, "content": preview, "content_id": fingerprint}
+
+def expand_chat_history(chat_history):
+    """Replace message previews with the full stored content where still available"""
+    offloaded = [msg for msg in chat_history if msg.get("content_id")]
+    contents = get_blobs([f"msg:{msg['content_id']}" for msg in offloaded])
+    full_content = {msg["content_id"]: content for msg, content in zip(offloaded, contents) if content is not None}
+    return [
+        {"role": msg["role"], "content": full_content.get(msg.get("content_id"), msg["content"])}
+        for msg in chat_history
+    ]
+
+def append_turn(chat_history, chat_hashes, user_query, response):
+    """
+    Return new (chat_history, chat_hashes) lists with the user query and assistant
+    response appended, skipping messages that are already present
+    """
+    chat_history = list(chat_history)
+    # Fingerprints are kept parallel to chat_history so membership checks are O(1)
+    if chat_hashes is None or len(chat_hashes) != len(chat_history):
+        chat_hashes = [
+            msg.get("content_id") or message_fingerprint(msg["role"], msg["content"])
+            for msg in chat_history
+        ]
+    chat_hashes = list(chat_hashes)
+    seen = set(chat_hashes)
+    
+    for role, content in (("user", user_query), ("assistant", response)):
+        fingerprint = message_fingerprint(role, content)
+        if fingerprint not in seen:
+            chat_history.append(make_history_entry(role, content, fingerprint))
+            chat_hashes.append(fingerprint)
+            seen.add(fingerprint)
+    
+    # Limit history length to prevent session from getting too large
+    if len(chat_history) > MAX_CHAT_HISTORY:
+        chat_history = chat_history[-MAX_CHAT_HISTORY:]
+        chat_hashes = chat_hashes[-MAX_CHAT_HISTORY:]
+    
+    return chat_history, chat_hashes
+
+def update_chat_history(user_query, response):
+    """
+    Append the user query and assistant response to the session chat history
+    and return the updated history
+    """
+    chat_history, chat_hashes = append_turn(
+        session.get('chat_history', []), session.get('chat_hashes'), user_query, response
+    )
+    session['chat_history'] = chat_history
+    session['chat_hashes'] = chat_hashes
+    return chat_history
+
+# Streamed answers finish after the session has already been saved, so completed
+# turns are parked as blobs and merged into the session on the next request
+COMPLETED_TURN_TTL = 3600  # seconds
+
+def store_completed_turn(turn_id, response):
+    put_blob(f"turn:{turn_id}", response, COMPLETED_TURN_TTL)
+
+def pop_completed_turn(turn_id):
+    return pop_blob(f"turn:{turn_id}")
+
+def merge_pending_turn():
+    """Move finished streamed answers into the session chat history, oldest first"""
+    pending_turns = session.get('pending_turns')
+    if not pending_turns:
+        return
+    remaining = list(pending_turns)
+    while remaining:
+        pending_turn = remaining[0]
+        response = pop_completed_turn(pending_turn['id'])
+        if response is None:
+            if time.time() - pending_turn.get('started', 0) < COMPLETED_TURN_TTL:
+                break  # Still streaming; later turns wait so the history stays in order
+            remaining.pop(0)  # The stream was abandoned
+            continue
+        remaining.pop(0)
+        update_chat_history(pending_turn['query'], response)
+    if len(remaining) != len(pending_turns):
+        session['pending_turns'] = remaining
+
+def sse_event(payload):
+    """Format a payload as a server-sent event"""
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+async def _anext_tracked(async_gen, pending):
+    """Run one __anext__ step as a task that _close_async_gen can cancel and wait for"""
+    pending[:] = [asyncio.ensure_future(async_gen.__anext__())]
+    return await pending[0]
+
+async def _close_async_gen(async_gen, pending):
+    """Close an async generator once its last step has settled; aclose() fails while it still runs"""
+    if pending and not pending[0].done():
+        pending[0].cancel()
+        await asyncio.wait(pending)
+    try:
+        await async_gen.aclose()
+    except Exception as e:
+        logger.error(f"Error closing async generator: {e}")
+
+def iterate_on_event_loop(async_gen, timeout=ORCHESTRATOR_TIMEOUT):
+    """Drive an async generator on the background event loop from synchronous code"""
+    deadline = time.monotonic() + timeout
+    pending = []  # The step currently running on the loop
+    try:
+        while True:
+            future = asyncio.run_coroutine_threadsafe(_anext_tracked(async_gen, pending), _event_loop)
+            try:
+                yield future.result(timeout=max(0, deadline - time.monotonic()))
+            except StopAsyncIteration:
+                return
+    finally:
+        # A step that timed out is cancelled there, then the generator is closed
+        asyncio.run_coroutine_threadsafe(_close_async_gen(async_gen, pending), _event_loop)
 
 @app.route('/')
 def index():
@@ -153,7 +548,96 @@ def index():
 
 @app.route('/api/current_chat_history', methods=['GET'])
 def get_current_chat_history():
-    return jsonify(session.get('chat_history', []))
+    merge_pending_turn()
+    return jsonify(expand_chat_history(session.get('chat_history', [])))
+
+@app.route('/api/message/<content_id>', methods=['GET'])
+def get_message(content_id):
+    # Only serve messages that belong to this session's history
+    if not any(msg.get('content_id') == content_id for msg in session.get('chat_history', [])):
+        return jsonify({'error': 'Message not found'}), 404
+    content = get_blobs([f"msg:{content_id}"])[0]
+    if content is None:
+        return jsonify({'error': 'Message expired'}), 404
+    return jsonify({'content_id': content_id, 'content': content})
+
+FALLBACK_RESPONSE = """
+                <div class="alert alert-warning">
+                    <h4>Không tìm thấy thông tin</h4>
+                    <p>Xin lỗi, tôi không tìm thấy thông tin liên quan đến câu hỏi của bạn trong cơ sở dữ liệu hiện có.</p>
+                    <p>Câu hỏi của bạn có thể nằm ngoài phạm vi thông tin tuyển sinh hoặc các tài liệu đã tải lên. 
+                    Vui lòng thử lại với một câu hỏi khác về thông tin tuyển sinh, hoặc liên hệ với phòng tuyển sinh để được hỗ trợ thêm.</p>
+                </div>
+                """
+
+LOADING_RESPONSE = """
+                <div class="alert alert-info">
+                    <p>Đang tải dữ liệu, vui lòng thử lại sau vài giây.</p>
+                </div>
+                """
+
+def build_context(processed_docs, readable_sources):
+    """Join the retrieved documents and the source hint block into one prompt context"""
+    # Documents plus detailed file sources with file prioritization hints, joined once
+    context_parts = ["\n\n".join(processed_docs)]
+    if readable_sources:
+        context_parts.append(build_source_info(tuple(readable_sources)))
+    return "".join(context_parts)
+
+def finalize_response(user_query, response, processed_docs, readable_sources, chat_history, query_vector):
+    """
+    Apply the Gemini fallback to an orchestrator response, clean its HTML and
+    store it in the semantic cache. The fallback context is only built when needed.
+    """
+    # Fallback to regular Gemini if orchestrator fails or returns None
+    cacheable = True
+    if not response or (isinstance(response, str) and "error" in response.lower()):
+        logger.warning(f"Orchestrator failed, falling back to standard Gemini API")
+        try:
+            context = build_context(processed_docs, readable_sources)
+            logger.info(f"Fallback context length: {len(context)} characters")
+            response = generate_response(user_query, context, chat_history)
+        except Exception as gemini_error:
+            logger.error(f"Error with Gemini API: {gemini_error}")
+            cacheable = False
+            # Provide a fallback response when both methods fail
+            response = FALLBACK_RESPONSE
+    
+    # Clean the response HTML to ensure proper rendering
+    response = clean_html_response(response)
+
+    # Only cache real answers, not error messages or the fallback warning
+    if query_vector is not None and cacheable and "đã xảy ra lỗi" not in response:
+        response_cache.add(user_query, query_vector, response)
+    
+    return response
+
+def stream_answer(turn, processed_docs, file_sources, readable_sources, chat_history, chat_hashes, query_vector):
+    """Generate server-sent events for an orchestrator answer as it is produced"""
+    user_query = turn['query']
+    parts = []
+    try:
+        for delta in iterate_on_event_loop(orchestrate_response_stream(user_query, processed_docs, file_sources)):
+            if delta is STREAM_RESET:
+                # The orchestrator replaced its answer, drop what was streamed so far
+                parts.clear()
+                yield sse_event({'delta': '', 'reset': True})
+                continue
+            parts.append(delta)
+            yield sse_event({'delta': delta})
+    except FutureTimeoutError:
+        logger.error(f"Orchestrator timed out after {ORCHESTRATOR_TIMEOUT} seconds")
+    except Exception as e:
+        logger.error(f"Error streaming orchestrator response: {e}")
+    
+    try:
+        response = finalize_response(user_query, "".join(parts) or None, processed_docs, readable_sources, chat_history, query_vector)
+        store_completed_turn(turn['id'], response)
+        chat_history, _ = append_turn(chat_history, chat_hashes, user_query, response)
+        yield sse_event({'done': True, 'response': response, 'chat_history': chat_history})
+    except Exception as e:
+        logger.error(f"Error in chat stream: {str(e)}")
+        yield sse_event({'error': f'Error: {str(e)}'})
 
 @app.route('/chat', methods=['POST'])
 def chat():
@@ -164,6 +648,9 @@ def chat():
         if not user_query:
             return jsonify({'error': 'No message provided'}), 400
         
+        # Pick up the previous streamed answer, if any
+        merge_pending_turn()
+        
         # Get chat history from session
         if 'chat_history' not in session:
             session['chat_history'] = []
@@ -171,202 +658,116 @@ def chat():
         chat_history = session['chat_history']
         
         # Check if the query is conversational (greeting, small talk, etc.)
-        conversational_response = conversation_handler.get_response(user_query)
+        query_type = classify_conversational_query(normalize_query(user_query))
+        conversational_response = conversation_handler.get_response_for_type(query_type)
         if conversational_response:
             logger.info(f"Detected conversational query, responding with predefined response")
             
-            # # Update chat history
-            # chat_history.append({"role": "user", "content": user_query})
-            # chat_history.append({"role": "assistant", "content": conversational_response})
-            
-            if not any(msg["content"] == user_query and msg["role"] == "user" for msg in chat_history):
-                chat_history.append({"role": "user", "content": user_query})
-            if not any(msg["content"] == conversational_response and msg["role"] == "assistant" for msg in chat_history):
-                chat_history.append({"role": "assistant", "content": conversational_response})
-            
-            if len(chat_history) > 20:
-                chat_history = chat_history[-20:]
-
-            session['chat_history'] = chat_history
+            chat_history = update_chat_history(user_query, conversational_response)
             
             return jsonify({
                 'response': conversational_response,
                 'chat_history': chat_history
             })
         
+        # Short chit-chat that slipped past the conversation handler gets one direct
+        # Gemini call, without the embedding pass, retrieval or the agent pipeline
+        if is_small_talk(user_query):
+            logger.info(f"Short non-admission query, skipping retrieval: {user_query}")
+            try:
+                response = generate_small_talk_response(user_query) or FALLBACK_RESPONSE
+            except Exception as gemini_error:
+                logger.error(f"Error with Gemini API: {gemini_error}")
+                response = FALLBACK_RESPONSE
+            response = clean_html_response(response)
+            chat_history = update_chat_history(user_query, response)
+            
+            return jsonify({
+                'response': response,
+                'chat_history': chat_history
+            })
+        
+        # Documents are still loading in the background
+        if not _READY.is_set():
+            logger.info("Vector store not ready yet, asking the user to retry")
+            return jsonify({
+                'response': LOADING_RESPONSE,
+                'chat_history': chat_history
+            })
+        
+        # Check the semantic cache before running the retrieval pipeline
+        query_vector = None
+        if vector_store.documents and hasattr(vector_store, 'embed_query'):
+            query_vector = vector_store.embed_query(user_query)
+            cached_response = response_cache.lookup(user_query, query_vector)
+            if cached_response:
+                logger.info(f"Serving cached response for query: {user_query}")
+                chat_history = update_chat_history(user_query, cached_response)
+
+                return jsonify({
+                    'response': cached_response,
+                    'chat_history': chat_history
+                })
+
         # Not a conversational query, proceed with retrieval-based response
         # Retrieve relevant context using RAG - find documents related to the user's query
-        # For better results, we'll use the similarity search with many results and a low threshold
-        # to get as much contextually relevant information as possible
+        # The store applies the similarity threshold, so weak matches never reach the prompt
         if vector_store.documents:
-            # Get more relevant documents (up to 10) with a very low similarity threshold
-            context_docs = vector_store.similarity_search(user_query, k=10, threshold=0.001)
+            context_docs = vector_store.similarity_search(user_query, k=SEARCH_TOP_K, threshold=SEARCH_THRESHOLD)
             logger.info(f"Found {len(context_docs)} relevant documents for query: {user_query}")
-            
-            # If no documents found with similarity search, use all documents
-            if not context_docs or len(context_docs) == 0 or len(context_docs[0]) < 100:
-                # Use all documents but limit total context size
-                max_docs = min(5, len(vector_store.documents))  # Use up to 5 documents
-                context_docs = vector_store.documents[:max_docs]
-                logger.info(f"Using {len(context_docs)} full documents as context for query: {user_query}")
         else:
             # No documents available
-            context_docs = ["No documents available in the knowledge base yet. Please upload PDF files."]
+            context_docs = [(None, "No documents available in the knowledge base yet. Please upload PDF files.")]
         
-        # Extract file sources from context documents
-        file_sources = []
-        processed_docs = []
-        
-        for doc in context_docs:
-            # Parse source file information from the document
-            try:
-                if doc.startswith("SOURCE_FILE:"):
-                    # Extract the source file name from the tag
-                    source_line = doc.split('\n')[0]  # Get the first line with source info
-                    file_id = source_line.replace("SOURCE_FILE:", "").strip()
-                    
-                    # Add to list of sources if not already included
-                    if file_id not in file_sources:
-                        file_sources.append(file_id)
-                    
-                    # Remove the source tag line for the content
-                    processed_content = "\n".join(doc.split('\n')[1:])
-                    processed_docs.append(processed_content)
-                else:
-                    # No source tag, use as is
-                    processed_docs.append(doc)
-            except Exception as e:
-                logger.error(f"Error parsing document source: {e}")
-                processed_docs.append(doc)  # Use original if any error
+        # The store returns (file source, content) pairs, so no per-query tag parsing is needed
+        processed_docs = [content for _, content in context_docs]
+        file_sources = list(dict.fromkeys(source for source, _ in context_docs if source))
         
         # Convert file IDs to original filenames for better human readability
-        readable_sources = []
-        for file_id in file_sources:
-            if file_id in file_information:
-                # Use the original filename stored during upload
-                readable_sources.append(file_information[file_id]['filename'])
-            else:
-                # For files with UUID prefixes, extract the original name
-                if '_' in file_id and any(c for c in file_id if c == '-'):
-                    # This is likely a UUID prefixed filename pattern
-                    try:
-                        # Extract the part after UUID
-                        original_name = file_id.split('_', 1)[1] if '_' in file_id else file_id
-                        readable_sources.append(original_name)
-                    except:
-                        # Fallback to the ID if extraction fails
-                        readable_sources.append(file_id)
-                else:
-                    # Just use the filename directly if no UUID pattern
-                    readable_sources.append(file_id)
+        readable_sources = [readable_source_name(file_id) for file_id in file_sources]
         
         # Log context found for debugging
         if processed_docs:
             logger.info(f"Found {len(processed_docs)} relevant context documents from {len(file_sources)} files for query: {user_query}")
             logger.info(f"Source files: {', '.join(readable_sources)}")
-            for i, doc in enumerate(processed_docs):
-                logger.debug(f"Context {i+1}: {doc[:200]}...")
-                
-        context = "\n\n".join(processed_docs)
-        
-        # Add detailed file sources to the context for the API with file prioritization hints
-        if readable_sources:
-            # Group files by type to help with prioritization hints
-            file_categories = {
-                'diem_chuan': [],
-                'hoc_phi': [],
-                'nganh_hoc': [],
-                'co_so': [],
-                'tuyen_sinh': [],
-                'other': []
-            }
-            
-            # Categorize files for better searching
-            for filename in readable_sources:
-                filename_lower = filename.lower()
-                if 'diem' in filename_lower or 'chuan' in filename_lower:
-                    file_categories['diem_chuan'].append(filename)
-                elif 'hoc_phi' in filename_lower or 'phi' in filename_lower:
-                    file_categories['hoc_phi'].append(filename)
-                elif 'nganh' in filename_lower or 'khoa' in filename_lower:
-                    file_categories['nganh_hoc'].append(filename)
-                elif 'co_so' in filename_lower or 'vat_chat' in filename_lower:
-                    file_categories['co_so'].append(filename)
-                elif 'tuyen_sinh' in filename_lower or 'tuyen' in filename_lower:
-                    file_categories['tuyen_sinh'].append(filename)
-                else:
-                    file_categories['other'].append(filename)
-            
-            # Add metadata about files and prioritization hints
-            source_info = "\n\n### SOURCE FILES AND PRIORITIZATION HINTS:\n"
-            source_info += "THIS INFORMATION IS FOUND IN THE FOLLOWING FILES: " + ", ".join(readable_sources) + "\n"
-            
-            # Add hints about file categories to help API prioritize correctly
-            if file_categories['diem_chuan']:
-                source_info += "\nFILES ABOUT ĐIỂM CHUẨN (PRIORITY FOR QUESTIONS ABOUT ADMISSION SCORES): " + ", ".join(file_categories['diem_chuan'])
-            if file_categories['hoc_phi']:
-                source_info += "\nFILES ABOUT HỌC PHÍ (PRIORITY FOR QUESTIONS ABOUT TUITION FEES): " + ", ".join(file_categories['hoc_phi'])
-            if file_categories['nganh_hoc']:
-                source_info += "\nFILES ABOUT NGÀNH HỌC (PRIORITY FOR QUESTIONS ABOUT MAJORS/DEPARTMENTS): " + ", ".join(file_categories['nganh_hoc'])
-            if file_categories['co_so']:
-                source_info += "\nFILES ABOUT CƠ SỞ VẬT CHẤT (PRIORITY FOR QUESTIONS ABOUT FACILITIES): " + ", ".join(file_categories['co_so'])
-            if file_categories['tuyen_sinh']:
-                source_info += "\nFILES ABOUT TUYỂN SINH (PRIORITY FOR QUESTIONS ABOUT ADMISSIONS): " + ", ".join(file_categories['tuyen_sinh'])
-            if file_categories['other']:
-                source_info += "\nOTHER FILES: " + ", ".join(file_categories['other'])
+            if logger.isEnabledFor(logging.DEBUG):
+                for i, doc in enumerate(processed_docs):
+                    logger.debug("Context %d: %.200s...", i + 1, doc)
                 
-            context += source_info
+        # Debug: Log length of context; the joined context itself is only built for the fallback
+        logger.info(f"Context length: {sum(map(len, processed_docs))} characters")
         
-        # Debug: Log length of context
-        logger.info(f"Context length: {len(context)} characters")
+        # Stream the answer as server-sent events when the client asks for it
+        if 'text/event-stream' in request.headers.get('Accept', ''):
+            turn = {'id': uuid.uuid4().hex, 'query': user_query, 'started': time.time()}
+            # Queue behind any earlier stream that has not been merged yet
+            session['pending_turns'] = session.get('pending_turns', []) + [turn]
+            return Response(
+                stream_with_context(stream_answer(
+                    turn, processed_docs, file_sources, readable_sources,
+                    chat_history, session.get('chat_hashes'), query_vector
+                )),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
         
         # Use Orchestrator-workers model for better search and extraction
-        # Run the async orchestrator in a synchronous environment
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+        # Submit the async orchestrator to the persistent background loop
+        future = asyncio.run_coroutine_threadsafe(
+            orchestrate_response(user_query, processed_docs, file_sources), _event_loop
+        )
         try:
-            response = loop.run_until_complete(
-                orchestrate_response(user_query, processed_docs, file_sources)
-            )
-        finally:
-            loop.close()
-            
-        # Fallback to regular Gemini if orchestrator fails or returns None
-        if not response or (isinstance(response, str) and "error" in response.lower()):
-            logger.warning(f"Orchestrator failed, falling back to standard Gemini API")
-            try:
-                response = generate_response(user_query, context, chat_history)
-            except Exception as gemini_error:
-                logger.error(f"Error with Gemini API: {gemini_error}")
-                # Provide a fallback response when both methods fail
-                response = """
-                <div class="alert alert-warning">
-                    <h4>Không tìm thấy thông tin</h4>
-                    <p>Xin lỗi, tôi không tìm thấy thông tin liên quan đến câu hỏi của bạn trong cơ sở dữ liệu hiện có.</p>
-                    <p>Câu hỏi của bạn có thể nằm ngoài phạm vi thông tin tuyển sinh hoặc các tài liệu đã tải lên. 
-                    Vui lòng thử lại với một câu hỏi khác về thông tin tuyển sinh, hoặc liên hệ với phòng tuyển sinh để được hỗ trợ thêm.</p>
-                </div>
-                """
+            response = future.result(timeout=ORCHESTRATOR_TIMEOUT)
+        except FutureTimeoutError:
+            future.cancel()
+            logger.error(f"Orchestrator timed out after {ORCHESTRATOR_TIMEOUT} seconds")
+            response = None
         
-        # Clean the response HTML to ensure proper rendering
-        response = clean_html_response(response)
-
-        # # Update chat history
-        # chat_history.append({"role": "user", "content": user_query})
-        # chat_history.append({"role": "assistant", "content": response})
+        response = finalize_response(user_query, response, processed_docs, readable_sources, chat_history, query_vector)
 
         # Only append if not already in history
-        if not any(msg["content"] == user_query and msg["role"] == "user" for msg in chat_history):
-            chat_history.append({"role": "user", "content": user_query})
-        if not any(msg["content"] == response and msg["role"] == "assistant" for msg in chat_history):
-            chat_history.append({"role": "assistant", "content": response})
-        
-        # Limit history length to prevent session from getting too large
-        if len(chat_history) > 20:
-            chat_history = chat_history[-20:]
-
-        session['chat_history'] = chat_history
-        logger.debug(f"Returning chat history: {chat_history}")  # Debug log
+        chat_history = update_chat_history(user_query, response)
+        logger.debug("Returning chat history: %r", chat_history)  # Debug log
 
         return jsonify({
             'response': response,
@@ -380,6 +781,8 @@ def chat():
 def clear_chat():
     # Clear chat history from flask session
     session.pop('chat_history', None)
+    session.pop('chat_hashes', None)
+    session.pop('pending_turns', None)
     return jsonify({'stat us': 'success'})
 
 def calculate_relevance_score(query, documents):
@@ -397,6 +800,17 @@ def calculate_relevance_score(query, documents):
     # If no significant query words, consider any word
     if not query_words:
         query_words = set(query.split())
+    if not query_words:
+        return 0.0
+    
+    # Build a multi-keyword automaton once so each document is scanned in a single pass
+    automaton = None
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for word in query_words:
+            automaton.add_word(word, word)
+        automaton.make_automaton()
+    min_word_length = min(len(word) for word in query_words)
     
     # Count relevant documents (contain at least one query keyword)
     relevant_count = 0
@@ -408,12 +822,8 @@ def calculate_relevance_score(query, documents):
             doc_text = doc.page_content
         elif isinstance(doc, str):
             # String document
-            doc_text = doc
             # Remove source information if present
-            if doc.startswith("SOURCE_FILE:"):
-                parts = doc.split("\n", 1)
-                if len(parts) > 1:
-                    doc_text = parts[1]
+            doc_text = split_source_tag(doc)[1]
         elif isinstance(doc, dict):
             # Dictionary document
             doc_text = doc.get('content', str(doc))
@@ -424,8 +834,15 @@ def calculate_relevance_score(query, documents):
         # Convert to lowercase for case-insensitive matching
         doc_lower = doc_text.lower()
         
+        # Documents shorter than every keyword cannot match any of them
+        if len(doc_lower) < min_word_length:
+            continue
+        
         # Count matching keywords
-        matching_keywords = sum(1 for word in query_words if word in doc_lower)
+        if automaton is not None:
+            matching_keywords = len({word for _, word in automaton.iter(doc_lower)})
+        else:
+            matching_keywords = sum(1 for word in query_words if word in doc_lower)
         
         # If the document contains any keywords or matches the query semantically, consider it relevant
         if matching_keywords > 0:
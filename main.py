@@ -2,7 +2,8 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-from app import app 
-
 if __name__ == "__main__":
-    app.run(host="localhost", port=3000, debug=True)
\ No newline at end of file
+    # Imported here so processes spawned for PDF extraction, which re-run this file
+    # as __mp_main__, do not load the whole app
+    from app import app
+    app.run(host="localhost", port=3000, debug=True)
@@ -0,0 +1,177 @@
+import os
+import time
+import logging
+import pickle
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_query(query):
+    """
+    Normalize a user query for cache lookups (lowercase, collapsed whitespace)
+    """
+    return " ".join(query.lower().split())
+
+
+def cached_encoder(encode_fn, maxsize=2048):
+    """
+    Wrap a single-text encode function with an LRU cache so repeated queries
+    skip the transformer forward pass
+
+    Args:
+        encode_fn (callable): Function mapping a text to its embedding array
+        maxsize (int): Maximum number of cached embeddings
+
+    Returns:
+        callable: Cached version of encode_fn
+    """
+    @lru_cache(maxsize=maxsize)
+    def _embed(text):
+        vector = encode_fn(text)
+        # Cached arrays are shared between callers, so keep them read-only
+        vector.setflags(write=False)
+        return vector
+
+    return _embed
+
+
+class ResultCache:
+    """
+    Small thread-safe LRU map for Gemini results, with an optional time-to-live
+    """
+
+    def __init__(self, maxsize=512, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl  # Seconds an entry stays valid, or None to keep it until evicted
+        self.entries = OrderedDict()  # Key -> (expiry time or None, value)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value for key, or None if it is missing or expired"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Store a value, evicting the least recently used entry when full"""
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+class SemanticCache:
+    """
+    A response cache keyed by query embeddings.
+    Near-duplicate questions (cosine similarity above the threshold) reuse the
+    previously generated response instead of running the full RAG pipeline.
+    """
+
+    def __init__(self, threshold=0.95, maxsize=512):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.entries = OrderedDict()  # Normalized query -> (unit vector, response)
+        self._matrix = None  # Stacked unit vectors, rebuilt lazily after changes
+        self._keys = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _unit(vector):
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def lookup(self, query, query_vector):
+        """
+        Return a cached response for the query or a semantically similar one
+
+        Args:
+            query (str): User query
+            query_vector (np.ndarray): Embedding of the query
+
+        Returns:
+            str: Cached response, or None on a miss
+        """
+        key = normalize_query(query)
+        unit_vector = self._unit(query_vector)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key][1]
+
+            if not self.entries:
+                return None
+
+            if self._matrix is None:
+                self._keys = list(self.entries.keys())
+                self._matrix = np.vstack([vec for vec, _ in self.entries.values()])
+
+            scores = self._matrix @ unit_vector
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+            hit_key = self._keys[best]
+            self.entries.move_to_end(hit_key)
+            response = self.entries[hit_key][1]
+        logger.info(f"Semantic cache hit (score: {scores[best]:.4f}) for query: {query}")
+        return response
+
+    def add(self, query, query_vector, response):
+        """
+        Store a generated response for the query
+        """
+        key = normalize_query(query)
+        unit_vector = self._unit(query_vector)
+        with self.lock:
+            self.entries[key] = (unit_vector, response)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+            self._matrix = None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self._matrix = None
+            self._keys = []
+
+    def save_to_disk(self, filepath):
+        with self.lock:
+            items = list(self.entries.items())
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        # Every worker saves on exit, so each writes its own temp file and swaps it in
+        # atomically; readers never see a half-written pickle
+        tmp_path = f"{filepath}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(items, f)
+        os.replace(tmp_path, filepath)
+
+    def load_from_disk(self, filepath):
+        if not os.path.exists(filepath):
+            return False
+        try:
+            with open(filepath, "rb") as f:
+                items = pickle.load(f)
+            items = list(items)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, TypeError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable query cache at {filepath}: {e}")
+            return False
+        with self.lock:
+            self.entries = OrderedDict(items[-self.maxsize:])
+            self._matrix = None
+            self._keys = []
+        return True
@@ -2,16 +2,162 @@ import os
 import json
 import re
 import time
+import random
+import atexit
+import threading
+from collections import defaultdict, deque
+import concurrent.futures
+from functools import lru_cache
 import requests
+from requests.adapters import HTTPAdapter
 import logging
 from datetime import datetime
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to the standard json module
+    orjson = None
+try:
+    import ahocorasick
+except ImportError:  # pyahocorasick is optional, fall back to one substring scan per replacement
+    ahocorasick = None
+from .pdf_processor import split_source_tag
+from .embedding_cache import ResultCache, normalize_query
+
 # Load environment variables from .env file
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# One HTTP session shared by every agent, so keep-alive connections (and their TLS
+# handshakes) to the Gemini API are reused across requests
+_http_session = None
+_http_session_lock = threading.Lock()
+
+# (connect, read) timeouts for Gemini API calls, in seconds
+API_TIMEOUT = (5, 60)
+
+# Requests per minute allowed by the Gemini quota (15 on the free tier); 0 disables the limiter
+API_RPM = int(os.environ.get("GEMINI_RPM", "15"))
+
+def get_http_session():
+    """Return the process-wide requests.Session, creating it on first use"""
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                session = requests.Session()
+                # Retries are handled by GeminiAgent._call_api, so the adapter itself never retries
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0)
+                session.mount("https://", adapter)
+                session.headers.update({"Content-Type": "application/json"})
+                atexit.register(session.close)
+                _http_session = session
+    return _http_session
+
+# Blocking Gemini calls run on one thread pool shared by every request, orchestrator
+# and worker instead of a new pool per call
+MAX_PARALLEL_REQUESTS = int(os.environ.get("GEMINI_MAX_PARALLEL", (os.cpu_count() or 1) * 5))
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """Return the process-wide thread pool for blocking Gemini calls, creating it on first use"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=MAX_PARALLEL_REQUESTS, thread_name_prefix="gemini"
+                )
+    return _executor
+
+# Replace common text issues in Vietnamese PDFs (applied in this order)
+_CONTEXT_REPLACEMENTS = (
+    # Common fixes for words that might be concatenated in PDFs
+    ('THÔNGTINTUYỂNSINH', 'THÔNG TIN TUYỂN SINH'),
+    ('ĐẠIHỌCCHÍNHQUY', 'ĐẠI HỌC CHÍNH QUY'),
+    ('TrườngĐại', 'Trường Đại'),
+    ('họcMở', 'học Mở'),
+    ('ThànhphốHồ', 'Thành phố Hồ'),
+    ('ChíMinh', 'Chí Minh'),
+    ('dựkiến', 'dự kiến'),
+    ('phươnghướng', 'phương hướng'),
+    ('tuyểnsinh', 'tuyển sinh'),
+    ('đạihọc', 'đại học'),
+    ('chínhquy', 'chính quy'),
+    ('năm2025', 'năm 2025'),
+    ('cácnội', 'các nội'),
+    ('dungchính', 'dung chính'),
+    ('nhưsau', 'như sau'),
+    ('Chỉtiêu', 'Chỉ tiêu'),
+    ('ngànhđào', 'ngành đào'),
+    ('tạochuẩn', 'tạo chuẩn'),
+    ('phươngthức', 'phương thức'),
+    ('tốtnghiệp', 'tốt nghiệp'),
+    ('xéttrúng', 'xét trúng'),
+    ('họcbạ', 'học bạ'),
+    ('THPT', 'THPT '),
+    ('BGD', 'BGD '),
+    ('ĐT', 'ĐT '),
+    ('CăncứThông', 'Căn cứ Thông'),
+    ('CăncứĐề', 'Căn cứ Đề'),
+    ('tínchỉ', 'tín chỉ'),
+    ('ngàytháng', 'ngày tháng'),
+    ('kếtquả', 'kết quả'),
+    ('thờiđiểm', 'thời điểm'),
+    ('giáodục', 'giáo dục'),
+    ('ĐàoTạo', 'Đào Tạo'),
+    ('KếHoạch', 'Kế Hoạch'),
+    ('VănBằng', 'Văn Bằng'),
+    ('cógiá', 'có giá'),
+    ('trịtới', 'trị tới'),
+    ('mônxét', 'môn xét'),
+)
+
+# Every replacement only inserts spaces and no key contains one, so a replacement can
+# never create a new match: the keys found in the raw text are the only ones to apply
+if ahocorasick is not None:
+    _REPLACEMENT_AUTOMATON = ahocorasick.Automaton()
+    for _index, (_old, _new) in enumerate(_CONTEXT_REPLACEMENTS):
+        _REPLACEMENT_AUTOMATON.add_word(_old, _index)
+    _REPLACEMENT_AUTOMATON.make_automaton()
+else:
+    _REPLACEMENT_AUTOMATON = None
+
+def _apply_context_replacements(context):
+    """Apply _CONTEXT_REPLACEMENTS in order, skipping the keys absent from the context"""
+    if _REPLACEMENT_AUTOMATON is not None:
+        # One pass over the text finds every key present; the replacements still run in
+        # table order because some keys overlap (e.g. 'mônxét' and 'xéttrúng')
+        found = {index for _, index in _REPLACEMENT_AUTOMATON.iter(context)}
+        for index in sorted(found):
+            old, new = _CONTEXT_REPLACEMENTS[index]
+            context = context.replace(old, new)
+        return context
+    
+    # Most fixes are absent from a given context; the 'in' scan is much cheaper than replace
+    for old, new in _CONTEXT_REPLACEMENTS:
+        if old in context:
+            context = context.replace(old, new)
+    return context
+
+_UPPER_VI = 'A-ZĐÁÀẢÃẠÂẤẦẨẪẬĂẮẰẲẴẶÉÈẺẼẸÊẾỀỂỄỆÍÌỈĨỊÓÒỎÕỌÔỐỒỔỖỘƠỚỜỞỠỢÚÙỦŨỤƯỨỪỬỮỰÝỲỶỸỴ'
+_SECTION_HEADER_RE = re.compile(r'(\d+\.)([' + _UPPER_VI + r'])')
+_MISSING_PERIOD_RE = re.compile(r'([^.!?\s])\s+([A-Z])')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+# Cấu trúc các tiêu đề phần quan trọng cho rõ ràng
+_IMPORTANT_SECTIONS = tuple(
+    (section, f' ### {section.upper()} ### ')
+    for section in ['THÔNG TIN TUYỂN SINH', 'Chỉ tiêu', 'Phương thức', 'Điều kiện', 'Hồ sơ', 'Thời gian']
+)
+
+# The same retrieved documents come back for related queries, so processed contexts are
+# cached; str hashes are computed in C and cached on the object, and hits are confirmed
+# by an equality check, so no separate content digest is needed
+@lru_cache(maxsize=256)
 def prepare_vietnamese_context(context):
     """
     Prepares Vietnamese text context for better processing by Gemini API
@@ -25,115 +171,295 @@ def prepare_vietnamese_context(context):
     if not context:
         return ""
         
-    # Replace common text issues in Vietnamese PDFs
-    replacements = {
-        # Common fixes for words that might be concatenated in PDFs
-        'THÔNGTINTUYỂNSINH': 'THÔNG TIN TUYỂN SINH',
-        'ĐẠIHỌCCHÍNHQUY': 'ĐẠI HỌC CHÍNH QUY',
-        'TrườngĐại': 'Trường Đại',
-        'họcMở': 'học Mở',
-        'ThànhphốHồ': 'Thành phố Hồ',
-        'ChíMinh': 'Chí Minh',
-        'dựkiến': 'dự kiến',
-        'phươnghướng': 'phương hướng',
-        'tuyểnsinh': 'tuyển sinh',
-        'đạihọc': 'đại học',
-        'chínhquy': 'chính quy',
-        'năm2025': 'năm 2025',
-        'cácnội': 'các nội',
-        'dungchính': 'dung chính',
-        'nhưsau': 'như sau',
-        'Chỉtiêu': 'Chỉ tiêu',
-        'ngànhđào': 'ngành đào',
-        'tạochuẩn': 'tạo chuẩn',
-        'phươngthức': 'phương thức',
-        'tốtnghiệp': 'tốt nghiệp',
-        'xéttrúng': 'xét trúng',
-        'họcbạ': 'học bạ',
-        'THPT': 'THPT ',
-        'BGD': 'BGD ',
-        'ĐT': 'ĐT ',
-        'CăncứThông': 'Căn cứ Thông',
-        'CăncứĐề': 'Căn cứ Đề',
-        'tínchỉ': 'tín chỉ',
-        'ngàytháng': 'ngày tháng',
-        'kếtquả': 'kết quả',
-        'thờiđiểm': 'thời điểm',
-        'giáodục': 'giáo dục',
-        'ĐàoTạo': 'Đào Tạo',
-        'KếHoạch': 'Kế Hoạch',
-        'VănBằng': 'Văn Bằng',
-        'cógiá': 'có giá',
-        'trịtới': 'trị tới',
-        'mônxét': 'môn xét',
-    }
+    context = _apply_context_replacements(context)
     
-    for old, new in replacements.items():
-        context = context.replace(old, new)
+    # Lưu ý: bước chuẩn hóa khoảng trắng cuối cùng gộp mọi chuỗi khoảng trắng (kể cả xuống dòng)
+    # thành một dấu cách, nên các bước trước chỉ cần chèn dấu cách thay vì xuống dòng
     
     # Nhận diện tiêu đề section (số theo sau bởi dấu chấm và chữ cái in hoa)
-    context = re.sub(r'(\d+\.)([A-ZĐÁÀẢÃẠÂẤẦẨẪẬĂẮẰẲẴẶÉÈẺẼẸÊẾỀỂỄỆÍÌỈĨỊÓÒỎÕỌÔỐỒỔỖỘƠỚỜỞỠỢÚÙỦŨỤƯỨỪỬỮỰÝỲỶỸỴ])', r'\n\n\1 \2', context)
+    context = _SECTION_HEADER_RE.sub(r' \1 \2', context)
     
     # Đảm bảo có dấu chấm ở cuối mỗi câu
-    context = re.sub(r'([^.!?\s])\s+([A-Z])', r'\1. \2', context)
-    
-    # Định dạng đoạn văn và section tốt hơn    
-    context = re.sub(r'([.?!])\s+', r'\1\n', context)  # Xuống dòng sau mỗi câu
-    context = re.sub(r'\n{3,}', '\n\n', context)  # Thay thế các dòng trống
+    context = _MISSING_PERIOD_RE.sub(r'\1. \2', context)
     
     # Cấu trúc các tiêu đề phần quan trọng cho rõ ràng
-    important_sections = ['THÔNG TIN TUYỂN SINH', 'Chỉ tiêu', 'Phương thức', 'Điều kiện', 'Hồ sơ', 'Thời gian']
+    for section, heading in _IMPORTANT_SECTIONS:
+        if section in context:
+            context = context.replace(section, heading)
+    
+    # Final cleanup: chuẩn hóa khoảng trắng
+    context = _WHITESPACE_RE.sub(' ', context)
     
-    for section in important_sections:
-        context = context.replace(section, f'\n\n### {section.upper()} ###\n')
+    return context
+
+def prepare_documents(docs):
+    """
+    Run prepare_vietnamese_context over each non-empty document once
+    
+    Args:
+        docs (list): Raw document texts
+        
+    Returns:
+        dict: Raw document text -> processed text
+    """
+    return {doc: prepare_vietnamese_context(doc) for doc in dict.fromkeys(docs) if doc.strip()}
+
+_DOCUMENT_SEPARATOR = "\n\n---\n\n"
+
+def join_prepared_documents(docs, sources, max_chars, prepared_docs=None):
+    """
+    Join non-empty documents into one prompt context, each under a FILE: header
     
-    # Final cleanup
-    context = re.sub(r'\s+', ' ', context)  # Chuẩn hóa khoảng trắng
-    context = re.sub(r'\n\s+', '\n', context)  #  Xóa khoảng trắng ở đầu dòng
-    context = re.sub(r'\n{3,}', '\n\n', context)  # Giới hạn các dòng trống liên tiếp thành 2
+    Documents are processed one at a time and the loop stops as soon as max_chars
+    is exceeded, so documents that would be truncated away are never processed.
     
+    Args:
+        docs (list): Raw document texts, in priority order
+        sources (list): Source file name of each document
+        max_chars (int): Context size limit; longer contexts are truncated with a marker
+        prepared_docs (dict): Optional raw text -> prepare_vietnamese_context output
+        
+    Returns:
+        str: The joined, processed context
+    """
+    parts = []
+    total = 0
+    for doc, source in zip(docs, sources):
+        if not doc.strip():  # Only add non-empty documents
+            continue
+        prepared = prepared_docs.get(doc) if prepared_docs is not None else None
+        part = f"FILE: {source}\n{prepared or prepare_vietnamese_context(doc)}"
+        total += len(part) + (len(_DOCUMENT_SEPARATOR) if parts else 0)
+        parts.append(part)
+        if total > max_chars:
+            break
+    
+    context = _DOCUMENT_SEPARATOR.join(parts)
+    if len(context) > max_chars:
+        context = context[:max_chars] + "\n\n...(truncated for length)..."
     return context
 
+# Thứ tự ưu tiên tệp theo chủ đề câu hỏi, xét lần lượt từ trên xuống
+_TOPIC_FILE_PRIORITIES = tuple((re.compile(pattern), priority) for pattern, priority in (
+    (r"điểm", ("diem_chuan.pdf", "thong_tin_tuyen_sinh_2025.pdf", "thong_tin_tuyen_sinh_2024.pdf")),
+    (r"phí|học bổng", ("hoc_phi_hoc_bong.pdf", "thong_tin_tuyen_sinh_2025.pdf")),
+    (r"ngành|khoa|đào tạo", ("thong_tin_nganh_hoc.pdf", "thong_tin_tuyen_sinh_2025.pdf", "thong_tin_tuyen_sinh_2024.pdf")),
+    (r"vị trí|việc làm|cơ hội|nghề nghiệp", ("thong_tin_nganh_hoc.pdf",)),
+    (r"cơ sở|vật chất|thư viện", ("co_so_vat_chat.pdf", "thong_tin_tuyen_sinh_2025.pdf")),
+    (r"tuyển|chỉ tiêu|tổ hợp|trường", ("thong_tin_tuyen_sinh_2025.pdf", "thong_tin_tuyen_sinh_2024.pdf", "OU_info.pdf")),
+))
+
+# Upload prefix of stored files: "<uuid>_<original name>"
+_UUID_PREFIX_RE = re.compile(r'^[0-9a-fA-F-]{8,}_')
+
+def strip_uuid_prefix(file_name):
+    """Return the original file name, without the UUID prefix added on upload"""
+    return _UUID_PREFIX_RE.sub('', file_name, count=1)
+
+# Các ký tự có ý nghĩa khi tìm khối JSON: ngoặc nhọn, dấu nháy và ký tự escape
+_JSON_TOKEN_RE = re.compile(r'[{}"\\]')
+
+def find_json_object(text):
+    """
+    Find the first balanced {...} block in a model response, ignoring braces inside strings
+    
+    Args:
+        text (str): Model output that may wrap a JSON object in prose or code fences
+        
+    Returns:
+        str: The JSON object text, or None if there is no complete object
+    """
+    start = text.find('{')
+    if start < 0:
+        return None
+    
+    depth = 0
+    in_string = False
+    escaped_pos = -1  # Position of the character right after a backslash inside a string
+    for match in _JSON_TOKEN_RE.finditer(text, start):
+        pos = match.start()
+        if pos == escaped_pos:
+            continue
+        char = match.group(0)
+        if in_string:
+            if char == '\\':
+                escaped_pos = pos + 1
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                return text[start:match.end()]
+    return None
+
+def json_loads(data):
+    """Parse JSON with orjson when it is installed"""
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+def encode_payload(payload):
+    """Serialize a request payload to JSON bytes, with orjson when it is installed"""
+    return orjson.dumps(payload) if orjson is not None else json.dumps(payload).encode('utf-8')
+
+# Câu hỏi tuyển sinh lặp lại rất nhiều; lưu kết quả phân tích và kế hoạch theo câu hỏi đã chuẩn hóa
+_analysis_cache = ResultCache(maxsize=512)
+_plan_cache = ResultCache(maxsize=512)
+
+# Number of recorded actions an agent keeps for auditing and debugging
+MAX_ACTION_HISTORY = 1000
+
+# Sentinel: search_and_extract runs the query analysis itself unless one is passed in
+_NOT_ANALYZED = object()
+
+# A long first answer with a heading and structured content is accepted as-is,
+# skipping the reflection and improvement round-trips
+_CONFIDENT_ANSWER_MIN_LENGTH = 400
+_STRUCTURE_TAGS = ("<table", "<ul", "<strong")
+
 class GeminiAgent:
     """
     Agent-based interface for the Gemini API with ability to retrieve information,
     make decisions, and execute actions to achieve specific goals.
     """
     
+    # Timestamps of recent API requests, shared by every agent so the whole process stays under API_RPM
+    _request_times = deque()
+    _request_times_lock = threading.Lock()
+    
     def __init__(self, api_key=None):
         """Initialize the agent with an API key"""
         self.api_key = api_key or os.environ.get("GEMINI_API_KEY", "")
         self.memory = []
         self.file_priorities = {}
-        self.action_history = []
+        # Only the most recent actions are kept, so a long-lived agent does not grow without bound
+        self.action_history = deque(maxlen=MAX_ACTION_HISTORY)
         self.last_actions = {}
         
         if not self.api_key:
             logger.error("GEMINI_API_KEY not found in environment variables")
             raise ValueError("API key not configured. Please set the GEMINI_API_KEY environment variable.")
     
+    @classmethod
+    def _wait_for_rate_limit(cls):
+        """Block until another request fits in the rolling one-minute API_RPM window"""
+        if API_RPM <= 0:
+            return
+        while True:
+            with cls._request_times_lock:
+                now = time.monotonic()
+                while cls._request_times and now - cls._request_times[0] >= 60:
+                    cls._request_times.popleft()
+                if len(cls._request_times) < API_RPM:
+                    cls._request_times.append(now)
+                    return
+                wait = 60 - (now - cls._request_times[0])
+            logger.info(f"Gemini rate limit reached, waiting {wait:.1f} seconds")
+            time.sleep(wait)
+    
+    @staticmethod
+    def _get_retry_delay(response):
+        """
+        Read the server-suggested wait from a 429 response
+        
+        Args:
+            response (requests.Response): The rate-limited response
+            
+        Returns:
+            float: Seconds to wait before retrying
+        """
+        try:
+            # Gemini puts a google.rpc.RetryInfo entry such as {"retryDelay": "34s"} in the error details
+            for detail in response.json().get("error", {}).get("details", []):
+                retry_delay = detail.get("retryDelay")
+                if retry_delay:
+                    return float(retry_delay.rstrip("s"))
+        except (ValueError, AttributeError):
+            pass
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return float(retry_after)
+        return 60 / API_RPM if API_RPM > 0 else 4
+    
     def _call_api(self, payload):
         """Make a call to the Gemini API"""
         url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={self.api_key}"
-        headers = {"Content-Type": "application/json"}
         
-        # Thử lại cho các cuộc gọi API
+        # Thử lại cho các cuộc gọi API: 429 chờ theo gợi ý của server, 5xx và lỗi kết nối
+        # dùng backoff cấp số nhân, các lỗi 4xx khác thất bại ngay
         max_retries = 3
         retry_delay = 2
         
         for attempt in range(max_retries):
+            is_last_attempt = attempt == max_retries - 1
+            self._wait_for_rate_limit()
             try:
-                response = requests.post(url, headers=headers, data=json.dumps(payload))
-                response.raise_for_status()   # Gọi ngoại lệ cho các phản hồi 4XX và 5XX
-                return response.json()
+                response = get_http_session().post(url, data=encode_payload(payload), timeout=API_TIMEOUT)
             except requests.exceptions.RequestException as e:
                 logger.warning(f"API call attempt {attempt+1} failed: {e}")
-                if attempt < max_retries - 1:
-                    time.sleep(retry_delay)
-                    retry_delay *= 2  # Tăng thời gian chờ giữa các lần thử theo cấp số nhân
-                else:
+                if is_last_attempt:
                     raise
-    
+                time.sleep(retry_delay)
+                retry_delay *= 2  # Tăng thời gian chờ giữa các lần thử theo cấp số nhân
+                continue
+            
+            if response.ok:
+                return json_loads(response.content)
+            
+            if response.status_code == 429 and not is_last_attempt:
+                # Jitter keeps concurrent callers that were limited together from retrying in lockstep
+                wait = self._get_retry_delay(response) + random.uniform(0, 1)
+                logger.warning(f"API call attempt {attempt+1} was rate limited, retrying in {wait:.1f} seconds")
+                time.sleep(wait)
+            elif response.status_code >= 500 and not is_last_attempt:
+                logger.warning(f"API call attempt {attempt+1} failed with status {response.status_code}")
+                time.sleep(retry_delay)
+                retry_delay *= 2
+            else:
+                # Các lỗi 4xx khác (sai khóa API, payload không hợp lệ...) sẽ không thành công khi thử lại
+                response.raise_for_status()
+
+    def _call_api_stream(self, payload, opened=None):
+        """
+        Call the Gemini streaming endpoint and yield the answer text as it arrives.
+        Unlike _call_api this is not retried: text that was already yielded
+        cannot be taken back, so a failed stream simply raises.
+
+        Args:
+            payload (dict): Same request body as _call_api
+            opened (list): Optional list that receives the open HTTP response, so a
+                caller reading the stream from another thread can abort it
+
+        Yields:
+            str: Text deltas from the model
+        """
+        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:streamGenerateContent?alt=sse&key={self.api_key}"
+
+        self._wait_for_rate_limit()
+        with get_http_session().post(url, data=encode_payload(payload), timeout=API_TIMEOUT, stream=True) as response:
+            if opened is not None:
+                opened.append(response)
+            response.raise_for_status()
+            # text/event-stream không khai báo charset, nên chỉ định rõ để giải mã tiếng Việt
+            response.encoding = 'utf-8'
+            for line in response.iter_lines(decode_unicode=True):
+                # Mỗi sự kiện SSE có dạng "data: {...}"
+                if not line or not line.startswith("data:"):
+                    continue
+                text = self._process_stream_chunk(json_loads(line[5:]))
+                if text:
+                    yield text
+
+    def _process_stream_chunk(self, chunk_json):
+        """Extract the text delta from one streamGenerateContent event, if any"""
+        candidates = chunk_json.get("candidates") or ()
+        if not candidates:
+            return None
+        parts = candidates[0].get("content", {}).get("parts") or ()
+        return "".join(part.get("text", "") for part in parts)
+
     def _process_response(self, response_json):
         """Extract the text from the Gemini API response"""
         if "candidates" in response_json and len(response_json["candidates"]) > 0:
@@ -165,6 +491,12 @@ class GeminiAgent:
         """
         Phân tích câu truy vấn cua người dùng để xác định chủ đề, từ khóa và loại file PDF phù hợp
         """
+        cache_key = normalize_query(user_query)
+        cached_analysis = _analysis_cache.get(cache_key)
+        if cached_analysis is not None:
+            self._record_action("query_analysis_cached", {"query": user_query}, cached_analysis)
+            return cached_analysis
+        
         # System prompt for query analysis
         analysis_prompt = f"""
         Bạn là một trợ lý phân tích câu hỏi. Hãy phân tích câu hỏi sau về TUYỂN SINH và xác định:
@@ -201,14 +533,13 @@ class GeminiAgent:
                 return None
                 
             # Trích xuất JSON từ phản hồi
-            json_pattern = r'\{[\s\S]*\}'
-            match = re.search(json_pattern, analysis_text)
+            json_str = find_json_object(analysis_text)
             
-            if match:
-                json_str = match.group(0)
+            if json_str:
                 try:
-                    analysis_data = json.loads(json_str)
+                    analysis_data = json_loads(json_str)
                     self._record_action("query_analysis", {"query": user_query}, analysis_data)
+                    _analysis_cache.put(cache_key, analysis_data)
                     return analysis_data
                 except json.JSONDecodeError:
                     logger.error(f"Failed to parse JSON from analysis response: {json_str}")
@@ -225,6 +556,7 @@ class GeminiAgent:
             }
             
             self._record_action("query_analysis_fallback", {"query": user_query}, result)
+            _analysis_cache.put(cache_key, result)
             return result
             
         except Exception as e:
@@ -252,19 +584,11 @@ class GeminiAgent:
         topic = query_analysis.get("chủ_đề", "").lower()
         file_preference = query_analysis.get("file_ưu_tiên", "").lower()
         
-        # Determine priority based on topic
-        if "điểm" in topic or "điểm chuẩn" in topic:
-            priority = ["diem_chuan.pdf", "thong_tin_tuyen_sinh_2025.pdf", "thong_tin_tuyen_sinh_2024.pdf"]
-        elif "học phí" in topic or "phí" in topic or "học bổng" in topic:
-            priority = ["hoc_phi_hoc_bong.pdf", "thong_tin_tuyen_sinh_2025.pdf"]
-        elif "ngành" in topic or "khoa" in topic or "chuyên ngành" in topic or "đào tạo" in topic:
-            priority = ["thong_tin_nganh_hoc.pdf", "thong_tin_tuyen_sinh_2025.pdf", "thong_tin_tuyen_sinh_2024.pdf"]
-        elif "vị trí" in topic or "việc làm" in topic or "cơ hội" in topic or "ngành nghề" in topic or "nghề nghiệp" in topic:
-            priority = ["thong_tin_nganh_hoc.pdf"]
-        elif "cơ sở" in topic or "vật chất" in topic or "thư viện" in topic:
-            priority = ["co_so_vat_chat.pdf", "thong_tin_tuyen_sinh_2025.pdf"]
-        elif "tuyển sinh" in topic or "tuyển" in topic or "chỉ tiêu" or "tổ hợp" in topic or "trường" in topic:
-            priority = ["thong_tin_tuyen_sinh_2025.pdf", "thong_tin_tuyen_sinh_2024.pdf","OU_info.pdf"]
+        # Determine priority based on topic: the first matching rule wins
+        for topic_pattern, topic_priority in _TOPIC_FILE_PRIORITIES:
+            if topic_pattern.search(topic):
+                priority = list(topic_priority)
+                break
         else:
             # For unclassified topics, use the analysis file recommendation if available
             if file_preference:
@@ -278,49 +602,44 @@ class GeminiAgent:
         self._record_action("file_prioritization", {"topic": topic}, priority)
         return priority
 
-    def search_and_extract(self, user_query, context_docs, file_sources=None):
+    def search_and_extract(self, user_query, context_docs, file_sources=None, query_analysis=_NOT_ANALYZED):
         """Search through the context documents and extract relevant information"""
-        # First analyze the query to understand what we're looking for
-        query_analysis = self._analyze_query(user_query)
+        # First analyze the query to understand what we're looking for (unless the caller already did)
+        if query_analysis is _NOT_ANALYZED:
+            query_analysis = self._analyze_query(user_query)
         
         # Determine file priority based on the analysis
         file_priority = self._determine_file_priority(query_analysis)
         
         # Process context by categorizing documents by their source files
-        file_contexts = {}
+        file_contexts = defaultdict(list)
         if file_sources and context_docs:
             # Group context documents by their source files
-            for i, doc in enumerate(context_docs):
-                if i < len(file_sources) and file_sources[i]:
-                    file_name = file_sources[i]
+            for doc, source in zip(context_docs, file_sources):
+                if source:
                     # Handle UUIDs in filenames - extract the actual filename after the underscore
-                    if '_' in file_name and any(c for c in file_name if c == '-'):
-                        file_name = file_name.split('_', 1)[1] if '_' in file_name else file_name
-                    
-                    if file_name not in file_contexts:
-                        file_contexts[file_name] = []
-                    file_contexts[file_name].append(doc)
+                    file_contexts[strip_uuid_prefix(source)].append(doc)
         
         # Prioritize the documents based on the file priority
         prioritized_docs = []
         prioritized_sources = []
         
-        # Add documents from prioritized files first
-        for file_name in file_priority:
-            if file_name in file_contexts:
-                prioritized_docs.extend(file_contexts[file_name])
-                prioritized_sources.extend([file_name] * len(file_contexts[file_name]))
-        
-        # Add any remaining documents
-        for file_name, docs in file_contexts.items():
-            if file_name not in file_priority:
-                prioritized_docs.extend(docs)
-                prioritized_sources.extend([file_name] * len(docs))
+        # Add documents from prioritized files first, then any remaining documents
+        priority_files = set(file_priority)
+        ordered_files = [file_name for file_name in file_priority if file_name in file_contexts]
+        ordered_files.extend(file_name for file_name in file_contexts if file_name not in priority_files)
+        for file_name in ordered_files:
+            docs = file_contexts[file_name]
+            prioritized_docs.extend(docs)
+            prioritized_sources.extend([file_name] * len(docs))
         
         # If no files were prioritized, use the original order
         if not prioritized_docs and context_docs:
             prioritized_docs = context_docs
-            prioritized_sources = file_sources if file_sources else ["unknown"] * len(context_docs)
+            prioritized_sources = (
+                [strip_uuid_prefix(source) if source else "unknown" for source in file_sources]
+                if file_sources else ["unknown"] * len(context_docs)
+            )
         
         # Record the search action
         self._record_action("document_search", {
@@ -351,6 +670,13 @@ class GeminiAgent:
         topic = query_analysis.get("chủ_đề", "không xác định") if query_analysis else "không xác định"
         keywords = query_analysis.get("từ_khóa", "") if query_analysis else ""
         
+        # The plan only depends on the query, its analysis and the document previews
+        cache_key = (normalize_query(user_query), str(topic), str(keywords), doc_summary)
+        cached_plan = _plan_cache.get(cache_key)
+        if cached_plan is not None:
+            self._record_action("task_planning_cached", {"query": user_query}, cached_plan)
+            return cached_plan
+        
         # Create planning prompt
         planning_prompt = f"""
         Bạn là một trợ lý lập kế hoạch tìm kiếm thông tin. Với câu hỏi sau của người dùng, hãy lập ra kế hoạch để tìm kiếm thông tin chính xác và đầy đủ.
@@ -395,14 +721,13 @@ class GeminiAgent:
                 return None
                 
             # Try to extract JSON from the response
-            json_pattern = r'\{[\s\S]*\}'
-            match = re.search(json_pattern, plan_text)
+            json_str = find_json_object(plan_text)
             
-            if match:
-                json_str = match.group(0)
+            if json_str:
                 try:
-                    plan_data = json.loads(json_str)
+                    plan_data = json_loads(json_str)
                     self._record_action("task_planning", {"query": user_query}, plan_data)
+                    _plan_cache.put(cache_key, plan_data)
                     return plan_data
                 except json.JSONDecodeError:
                     logger.error(f"Failed to parse JSON from plan response: {json_str}")
@@ -422,25 +747,20 @@ class GeminiAgent:
             }
             
             self._record_action("task_planning_fallback", {"query": user_query}, result)
+            _plan_cache.put(cache_key, result)
             return result
             
         except Exception as e:
             logger.error(f"Error creating task plan: {e}")
             return None
     
-    def execute_plan(self, task_plan, user_query, prioritized_docs, prioritized_sources):
-        """Execute the task plan to answer the user's query"""
-        # Combine documents with their sources
-        doc_with_sources = []
-        for i, (doc, source) in enumerate(zip(prioritized_docs, prioritized_sources)):
-            if len(doc.strip()) > 0:  # Only add non-empty documents
-                # Extract the simple filename if it has a UUID prefix
-                simple_source = source
-                if '_' in source and any(c for c in source if c == '-'):
-                    simple_source = source.split('_', 1)[1] if '_' in source else source
-                
-                doc_with_sources.append(f"FILE: {simple_source}\n{doc}")
+    def execute_plan(self, task_plan, user_query, prioritized_docs, prioritized_sources, prepared_docs=None):
+        """
+        Execute the task plan to answer the user's query
         
+        prepared_docs, if given, maps each document to its prepare_vietnamese_context
+        output (see prepare_documents) so the context is not processed again here
+        """
         # Create a summary of the plan being executed
         plan_summary = "\n\nKẾ HOẠCH TÌM KIẾM THÔNG TIN:\n"
         if task_plan:
@@ -448,13 +768,10 @@ class GeminiAgent:
             plan_summary += f"- Thông tin cần tìm: {task_plan.get('thông_tin_cần_tìm', '')}\n"
             plan_summary += f"- Nguồn ưu tiên: {task_plan.get('nguồn_ưu_tiên', '')}\n"
         
-        # Prepare context with relevant documents
-        context = "\n\n---\n\n".join(doc_with_sources)
-        
-        # Process and limit context size
-        processed_context = prepare_vietnamese_context(context)
-        if len(processed_context) > 28000:
-            processed_context = processed_context[:28000] + "\n\n...(truncated for length)..."
+        # Prepare, combine and limit the context (search_and_extract already stripped UUID prefixes)
+        processed_context = join_prepared_documents(
+            prioritized_docs, prioritized_sources, 28000, prepared_docs
+        )
         
         # Create the execution prompt
         
@@ -508,7 +825,7 @@ class GeminiAgent:
             self._record_action("plan_execution", {
                 "query": user_query,
                 "documents_used": len(prioritized_docs),
-                "sources_used": list(set(prioritized_sources))
+                "sources_used": list(dict.fromkeys(prioritized_sources))
             })
             
             return answer
@@ -517,10 +834,28 @@ class GeminiAgent:
             logger.error(f"Error executing plan: {e}")
             return f"Xin lỗi, đã xảy ra lỗi khi tìm kiếm thông tin: {str(e)}"
     
+    @staticmethod
+    def is_confident_answer(answer):
+        """
+        Cheap local check of whether an answer is already complete and well formatted
+        
+        Args:
+            answer (str): Answer produced by execute_plan
+            
+        Returns:
+            bool: True if reflection and improvement can be skipped
+        """
+        return (
+            isinstance(answer, str)
+            and len(answer) > _CONFIDENT_ANSWER_MIN_LENGTH
+            and "<h4" in answer
+            and any(tag in answer for tag in _STRUCTURE_TAGS)
+        )
+    
     def reflect_and_improve(self, user_query, answer, prioritized_sources):
         """Reflect on the answer and suggest improvements"""
         # Create a list of unique sources
-        unique_sources = list(set(prioritized_sources))
+        unique_sources = list(dict.fromkeys(prioritized_sources))
         sources_list = ", ".join(unique_sources[:5])
         if len(unique_sources) > 5:
             sources_list += f" và {len(unique_sources) - 5} file khác"
@@ -565,13 +900,11 @@ class GeminiAgent:
                 return None
                 
             # Try to extract JSON from the response
-            json_pattern = r'\{[\s\S]*\}'
-            match = re.search(json_pattern, reflection_text)
+            json_str = find_json_object(reflection_text)
             
-            if match:
-                json_str = match.group(0)
+            if json_str:
                 try:
-                    reflection_data = json.loads(json_str)
+                    reflection_data = json_loads(json_str)
                     self._record_action("answer_reflection", {"query": user_query}, reflection_data)
                     return reflection_data
                 except json.JSONDecodeError:
@@ -583,37 +916,30 @@ class GeminiAgent:
             logger.error(f"Error in reflection: {e}")
             return None
     
-    def improve_answer(self, user_query, initial_answer, reflection, prioritized_docs, prioritized_sources):
-        """Improve the answer based on reflection"""
+    def improve_answer(self, user_query, initial_answer, reflection, prioritized_docs, prioritized_sources, prepared_docs=None):
+        """Improve the answer based on reflection (prepared_docs as in execute_plan)"""
         if not reflection or not any(prioritized_docs):
             return initial_answer
         
         # Extract improvement suggestions from reflection
         weaknesses = reflection.get("điểm_yếu", "")
         suggestions = reflection.get("đề_xuất_cải_thiện", "")
-        completion_level = reflection.get("mức_độ_hoàn_thành", "")
+        completion_level = str(reflection.get("mức_độ_hoàn_thành", ""))
         
         # Only proceed with improvement if the completion level is less than 90%
         # or if there are significant weaknesses or suggestions
         if ("90%" in completion_level or "100%" in completion_level) and not weaknesses and not suggestions:
             return initial_answer
         
-        # Combine documents with their sources for context
-        doc_with_sources = []
-        for i, (doc, source) in enumerate(zip(prioritized_docs[:3], prioritized_sources[:3])):
-            if len(doc.strip()) > 0:  # Only add non-empty documents
-                # Extract the simple filename if it has a UUID prefix
-                simple_source = source
-                if '_' in source and any(c for c in source if c == '-'):
-                    simple_source = source.split('_', 1)[1] if '_' in source else source
-                
-                doc_with_sources.append(f"FILE: {simple_source}\n{doc}")
+        # Suggestions this short carry nothing actionable for another round-trip
+        if len(str(suggestions)) < 20:
+            return initial_answer
         
         # Prepare limited context with relevant documents to fit within token limits
-        context = "\n\n---\n\n".join(doc_with_sources)
-        processed_context = prepare_vietnamese_context(context)
-        if len(processed_context) > 10000:  # Use a smaller limit for improvement context
-            processed_context = processed_context[:10000] + "\n\n...(truncated for length)..."
+        # (a smaller limit is used for the improvement context)
+        processed_context = join_prepared_documents(
+            prioritized_docs[:3], prioritized_sources[:3], 10000, prepared_docs
+        )
         
         # Create the improvement prompt
         improvement_prompt = f"""
@@ -676,6 +1002,23 @@ class GeminiAgent:
             return initial_answer
 
 
+# Agents are shared across requests (one per API key); their state is only the bounded
+# action log, and the HTTP session and result caches are module-level already
+_agents = {}
+_agents_lock = threading.Lock()
+
+def get_agent(api_key=None):
+    """Return the shared GeminiAgent for an API key, the GEMINI_API_KEY one by default"""
+    api_key = api_key or os.environ.get("GEMINI_API_KEY", "")
+    agent = _agents.get(api_key)
+    if agent is None:
+        with _agents_lock:
+            agent = _agents.get(api_key)
+            if agent is None:
+                agent = GeminiAgent(api_key=api_key)
+                _agents[api_key] = agent
+    return agent
+
 def generate_response(user_query, context, chat_history=None):
     """
     Generate a response using Google's Gemini API with agent-based approach
@@ -689,8 +1032,8 @@ def generate_response(user_query, context, chat_history=None):
         str: Generated response
     """  
     try:
-        # Initialize the Gemini Agent
-        agent = GeminiAgent()
+        # Get the shared Gemini Agent
+        agent = get_agent()
         
         # Extract file sources from context documents
         file_sources = []
@@ -703,31 +1046,22 @@ def generate_response(user_query, context, chat_history=None):
             context_docs = [context]
         
         for doc in context_docs:
-            # Parse source file information from the document
-            try:
-                if isinstance(doc, str) and doc.startswith("SOURCE_FILE:"):
-                    # Extract the source file name from the tag
-                    source_line = doc.split('\n')[0]  # Get the first line with source info
-                    file_id = source_line.replace("SOURCE_FILE:", "").strip()
-                    
-                    # Add to list of sources
-                    file_sources.append(file_id)
-                    
-                    # Remove the source tag line for the content
-                    processed_content = "\n".join(doc.split('\n')[1:])
-                    processed_docs.append(processed_content)
-                else:
-                    # No source tag, use as is
-                    processed_docs.append(doc)
-                    file_sources.append(None)  # No source for this document
-            except Exception as e:
-                logger.error(f"Error parsing document source: {e}")
-                processed_docs.append(doc)  # Use original if any error
-                file_sources.append(None)  # No source for this document
+            # Parse source file information from the document; untagged docs have no source
+            if isinstance(doc, str):
+                file_id, content = split_source_tag(doc)
+            else:
+                file_id, content = None, doc
+            file_sources.append(file_id)
+            processed_docs.append(content)
 
+        # The analysis call waits on the network while the documents are cleaned up locally
+        analysis_future = get_executor().submit(agent._analyze_query, user_query)
+        prepared_docs = prepare_documents(processed_docs)
+        query_analysis = analysis_future.result()
+        
         # Search and extract information from documents
         prioritized_docs, prioritized_sources, query_analysis = agent.search_and_extract(
-            user_query, processed_docs, file_sources
+            user_query, processed_docs, file_sources, query_analysis
         )
         
         # Formulate a task plan
@@ -738,9 +1072,14 @@ def generate_response(user_query, context, chat_history=None):
         
         # Execute the plan to generate an initial answer
         initial_answer = agent.execute_plan(
-            task_plan, user_query, prioritized_docs, prioritized_sources
+            task_plan, user_query, prioritized_docs, prioritized_sources, prepared_docs
         )
         
+        # A complete, well-formatted first answer does not need another two API calls
+        if agent.is_confident_answer(initial_answer):
+            agent._record_action("reflection_skipped", {"query": user_query})
+            return initial_answer
+        
         # Reflect on the answer and identify improvements
         reflection = agent.reflect_and_improve(
             user_query, initial_answer, prioritized_sources
@@ -748,7 +1087,7 @@ def generate_response(user_query, context, chat_history=None):
         
         # Improve the answer based on reflection
         final_answer = agent.improve_answer(
-            user_query, initial_answer, reflection, prioritized_docs, prioritized_sources
+            user_query, initial_answer, reflection, prioritized_docs, prioritized_sources, prepared_docs
         )
         
         return final_answer
@@ -802,13 +1141,11 @@ def generate_response(user_query, context, chat_history=None):
             }
         }
         
-        headers = {"Content-Type": "application/json"}
-        
         try:
-            response = requests.post(url, headers=headers, data=json.dumps(payload))
+            response = get_http_session().post(url, data=encode_payload(payload), timeout=API_TIMEOUT)
             
             if response.status_code == 200:
-                response_json = response.json()
+                response_json = json_loads(response.content)
                 
                 if "candidates" in response_json and len(response_json["candidates"]) > 0:
                     candidate = response_json["candidates"][0]
@@ -822,4 +1159,38 @@ def generate_response(user_query, context, chat_history=None):
                 return f"Xin lỗi, đã xảy ra lỗi khi xử lý yêu cầu. Lỗi: {response.status_code}"
                 
         except Exception as inner_e:
-            return f"Xin lỗi, đã xảy ra lỗi khi xử lý yêu cầu: {str(inner_e)}"
\ No newline at end of file
+            return f"Xin lỗi, đã xảy ra lỗi khi xử lý yêu cầu: {str(inner_e)}"
+def generate_small_talk_response(user_query):
+    """
+    Answer short chit-chat with a single Gemini call, without the agent pipeline's
+    analysis, planning and reflection calls
+
+    Args:
+        user_query (str): User's message
+
+    Returns:
+        str: Generated response, or None if Gemini returned nothing usable
+    """
+    prompt = f"""
+    Bạn là chatbot tư vấn tuyển sinh thân thiện của trường Đại học Mở Thành phố Hồ Chí Minh.
+    Tin nhắn sau không hỏi về thông tin tuyển sinh cụ thể. Hãy trả lời ngắn gọn, thân thiện và vui vẻ,
+    và mời người dùng đặt câu hỏi về tuyển sinh nếu phù hợp.
+
+    Tin nhắn: {user_query}
+    """
+    payload = {
+        "contents": [
+            {
+                "role": "user",
+                "parts": [{"text": prompt}]
+            }
+        ],
+        "generationConfig": {
+            "temperature": 0.5,
+            "topP": 0.95,
+            "topK": 40,
+            "maxOutputTokens": 512
+        }
+    }
+    agent = get_agent()
+    return agent._process_response(agent._call_api(payload))
@@ -1,18 +1,103 @@
 import os
 import json
+import hashlib
 import re
 import asyncio
 import time
 import logging
 import concurrent.futures
+from collections import defaultdict
 from datetime import datetime
+from functools import lru_cache
 from typing import List, Dict, Any, Optional, Tuple
 
-from .gemini_api import GeminiAgent
-from .gemini_api import prepare_vietnamese_context
+try:
+    import ahocorasick
+except ImportError:  # pyahocorasick is optional, fall back to one substring scan per keyword
+    ahocorasick = None
+
+from .gemini_api import get_agent, get_executor
+from .gemini_api import prepare_vietnamese_context, strip_uuid_prefix
+from .gemini_api import find_json_object, json_loads
+from .embedding_cache import ResultCache, normalize_query
 
 logger = logging.getLogger(__name__)
 
+# Worker tasks of one query that may call Gemini at the same time
+MAX_CONCURRENT_TASKS = int(os.environ.get("GEMINI_MAX_CONCURRENCY", "8"))
+
+# File contexts are sent to Gemini together, one extraction call per batch, while the
+# batch stays under this many characters (each context is already capped at 28000)
+BATCH_MAX_CHARS = 100000
+# Output budget per file in a batch, capped by the model's output limit
+BATCH_OUTPUT_TOKENS_PER_FILE = 2048
+MAX_OUTPUT_TOKENS = 8192
+
+# Admissions questions repeat a lot (điểm chuẩn, học phí...), so worker answers and
+# synthesized responses are reused for 15 minutes. Contexts are keyed by digest so
+# the cache does not keep every 28000-character context alive.
+_worker_result_cache = ResultCache(maxsize=4096, ttl=900)
+_synthesis_cache = ResultCache(maxsize=512, ttl=900)
+
+def _digest(text: str) -> bytes:
+    """Short content digest of a prompt or context, for cache keys"""
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+# Yielded by the streaming entry points when the text streamed so far must be discarded
+STREAM_RESET = object()
+
+# Common Vietnamese stopwords, ignored when matching query keywords
+_STOPWORDS = frozenset({
+    'và', 'của', 'là', 'cho', 'trong', 'về', 'từ', 'với', 'đến', 'tại',
+    'một', 'các', 'những', 'này', 'đó', 'nên', 'khi', 'thì', 'được',
+    'bằng', 'có', 'đã', 'sẽ', 'còn', 'vẫn'
+})
+_WORD_RE = re.compile(r'\w+')
+_DIGIT_RE = re.compile(r'\d')
+
+# File name fragment -> file type, checked in order
+_FILE_TYPE_RULES = (
+    ("diem_chuan", "điểm_chuẩn"),
+    ("hoc_phi", "học_phí_học_bổng"),
+    ("hoc_bong", "học_phí_học_bổng"),
+    ("nganh_hoc", "ngành_học"),
+    ("khoa", "ngành_học"),
+    ("co_so_vat_chat", "cơ_sở_vật_chất"),
+    ("tuyen_sinh", "tuyển_sinh"),
+)
+
+@lru_cache(maxsize=256)
+def _query_keywords(query: str) -> frozenset:
+    """Lowercase keywords of a query without common Vietnamese stopwords, computed once per query"""
+    return frozenset(_WORD_RE.findall(query.lower())) - _STOPWORDS
+
+@lru_cache(maxsize=256)
+def _keyword_automaton(words: frozenset):
+    """Aho-Corasick automaton over a query's keywords, shared by every task of that query"""
+    automaton = ahocorasick.Automaton()
+    for word in words:
+        automaton.add_word(word, word)
+    automaton.make_automaton()
+    return automaton
+
+def _count_keyword_matches(words: frozenset, text: str) -> int:
+    """
+    Count how many of the keywords occur in the text (as substrings)
+    
+    Args:
+        words (frozenset): Lowercase query keywords
+        text (str): Lowercase text to search
+        
+    Returns:
+        int: Number of distinct keywords found
+    """
+    if not words:
+        return 0
+    if ahocorasick is not None:
+        # One pass over the text instead of one substring scan per keyword
+        return len({word for _, word in _keyword_automaton(words).iter(text)})
+    return sum(1 for word in words if word in text)
+
 class Task:
     """Represents a task to be executed by a worker"""
     def __init__(self, task_id: str, query: str, context: str, source_file: str):
@@ -54,10 +139,12 @@ class Task:
 
 class Worker:
     """Worker that processes a task by using the Gemini API"""
-    def __init__(self, worker_id: str, api_key: Optional[str] = None):
+    def __init__(self, worker_id: str, api_key: Optional[str] = None,
+                 executor: Optional[concurrent.futures.Executor] = None):
         self.worker_id = worker_id
         self.api_key = api_key
-        self.agent = GeminiAgent(api_key=api_key)
+        self.agent = get_agent(api_key)
+        self.executor = executor or get_executor()
         self.processed_tasks = 0
         
     async def process_task(self, task: Task):
@@ -66,24 +153,20 @@ class Worker:
         task.mark_processing()
         
         try:
-            # Create a focused query for this specific document
-            prompt = self._create_worker_prompt(task.query, task.context, task.source_file)
-            
-            # Execute in thread pool to avoid blocking
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                result = await asyncio.get_event_loop().run_in_executor(
-                    executor, self._execute_query, prompt
+            cache_key = self._cache_key(task)
+            result = _worker_result_cache.get(cache_key)
+            if result is None:
+                # Create a focused query for this specific document
+                prompt = self._create_worker_prompt(task.query, task.context, task.source_file)
+                
+                # Execute in thread pool to avoid blocking
+                result = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self._execute_query, prompt
                 )
+                if result:
+                    _worker_result_cache.put(cache_key, result)
             
-            # Process and structure the result
-            task.mark_completed({
-                "content": result,
-                "source_file": task.source_file,
-                "relevance_score": self._calculate_relevance(result, task.query)
-            })
-            
-            self.processed_tasks += 1
-            logger.info(f"Worker {self.worker_id} completed task {task.task_id}")
+            self._complete_task(task, result)
             
         except Exception as e:
             logger.error(f"Worker {self.worker_id} failed on task {task.task_id}: {str(e)}")
@@ -91,7 +174,85 @@ class Worker:
             
         return task
     
-    def _execute_query(self, prompt: str) -> str:
+    async def process_batch(self, tasks: List[Task]) -> List[Task]:
+        """
+        Extract information for several tasks of the same query with one Gemini call
+        
+        Args:
+            tasks (list): Tasks of one query whose contexts fit in one prompt
+            
+        Returns:
+            list: Tasks the batched answer did not cover, to be run with process_task
+        """
+        pending = []
+        for task in tasks:
+            result = _worker_result_cache.get(self._cache_key(task))
+            if result is not None:
+                self._complete_task(task, result)
+            else:
+                pending.append(task)
+        if len(pending) < 2:
+            return pending
+        
+        logger.info(f"Worker {self.worker_id} processing {len(pending)} tasks in one batch: {[task.task_id for task in pending]}")
+        for task in pending:
+            task.mark_processing()
+        
+        try:
+            prompt = self._create_batch_prompt(pending[0].query, pending)
+            max_output_tokens = min(BATCH_OUTPUT_TOKENS_PER_FILE * len(pending), MAX_OUTPUT_TOKENS)
+            response = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self._execute_query, prompt, max_output_tokens
+            )
+            extracted = self._parse_batch_response(response, len(pending))
+        except Exception as e:
+            logger.warning(f"Worker {self.worker_id} batch failed, falling back to one call per file: {e}")
+            return pending
+        
+        leftovers = []
+        for index, task in enumerate(pending, 1):
+            result = extracted.get(index)
+            if result:
+                _worker_result_cache.put(self._cache_key(task), result)
+                self._complete_task(task, result)
+            else:
+                leftovers.append(task)
+        return leftovers
+    
+    def _cache_key(self, task: Task) -> Tuple[str, str, bytes]:
+        """Key of a task's answer in the worker result cache"""
+        return (normalize_query(task.query), task.source_file, _digest(task.context))
+    
+    def _complete_task(self, task: Task, result: str):
+        """Score an extracted answer and store it on the task"""
+        # Process and structure the result
+        task.mark_completed({
+            "content": result,
+            "source_file": task.source_file,
+            "relevance_score": self._calculate_relevance(result, task.query)
+        })
+        
+        self.processed_tasks += 1
+        logger.info(f"Worker {self.worker_id} completed task {task.task_id}")
+    
+    def _parse_batch_response(self, response: str, count: int) -> Dict[int, str]:
+        """Map each source number (1-based) in a batched answer to its extracted information"""
+        json_str = find_json_object(response or "")
+        if not json_str:
+            return {}
+        
+        extracted = {}
+        for item in json_loads(json_str).get("kết_quả", []):
+            try:
+                index = int(item.get("nguồn"))
+            except (AttributeError, TypeError, ValueError):
+                continue
+            info = item.get("thông_tin")
+            if 1 <= index <= count and isinstance(info, str) and info.strip():
+                extracted[index] = info.strip()
+        return extracted
+    
+    def _execute_query(self, prompt: str, max_output_tokens: int = 2048) -> str:
         """Execute a query using the Gemini API"""
         # Using the agent's _call_api method directly for more control
         payload = {
@@ -105,7 +266,7 @@ class Worker:
                 "temperature": 0.1,
                 "topP": 0.8,
                 "topK": 40,
-                "maxOutputTokens": 2048
+                "maxOutputTokens": max_output_tokens
             }
         }
         
@@ -139,22 +300,38 @@ class Worker:
         
         """
     
+    def _create_batch_prompt(self, query: str, tasks: List[Task]) -> str:
+        """Create one extraction prompt covering the file contexts of several tasks"""
+        sections = "\n\n".join(
+            f"### NGUỒN {index}: {task.source_file}\n{task.context}"
+            for index, task in enumerate(tasks, 1)
+        )
+        
+        return f"""
+        Bạn là trợ lý AI chuyên nghiệp hỗ trợ tư vấn tuyển sinh cho trường Đại học Mở Thành phố Hồ Chí Minh.
+        Bạn có khả năng tìm kiếm và trích xuất thông tin từ tài liệu từ đó đưa ra câu trả lời cho người dùng.
+        Nhiệm vụ của bạn là đọc TỪNG tài liệu sau đây và trích xuất thông tin cụ thể liên quan đến câu hỏi, riêng cho từng nguồn.
+        
+        CÂU HỎI: "{query}"
+        
+        {sections}
+        
+        HƯỚNG DẪN TRÍCH XUẤT (áp dụng riêng cho từng nguồn):
+        1. Chỉ trích xuất thông tin LIÊN QUAN TRỰC TIẾP đến câu hỏi
+        2. Nếu một tài liệu KHÔNG chứa thông tin liên quan, ghi cho nguồn đó: "Không tìm thấy thông tin liên quan trong tài liệu này."
+        3. KHÔNG bịa đặt hoặc suy luận thông tin không có trong tài liệu, KHÔNG trộn thông tin giữa các nguồn
+        4. Giữ nguyên các con số, tên riêng, và thuật ngữ chuyên ngành
+        5. Trích dẫn nội dung quan trọng bằng dấu ngoặc kép
+        6. Định dạng thông tin rõ ràng với tiêu đề và cấu trúc
+        
+        Chỉ trả về một đối tượng JSON, có đúng một phần tử cho mỗi nguồn:
+        {{"kết_quả": [{{"nguồn": 1, "thông_tin": "..."}}, {{"nguồn": 2, "thông_tin": "..."}}]}}
+        """
+    
     def _determine_file_type(self, filename: str) -> str:
         """Determine the type of file based on its name"""
         filename = filename.lower()
-        
-        if "diem_chuan" in filename:
-            return "điểm_chuẩn"
-        elif "hoc_phi" in filename or "hoc_bong" in filename:
-            return "học_phí_học_bổng"
-        elif "nganh_hoc" in filename or "khoa" in filename:
-            return "ngành_học"
-        elif "co_so_vat_chat" in filename:
-            return "cơ_sở_vật_chất"
-        elif "tuyen_sinh" in filename:
-            return "tuyển_sinh"
-        else:
-            return "khác"
+        return next((file_type for fragment, file_type in _FILE_TYPE_RULES if fragment in filename), "khác")
     
     def _calculate_relevance(self, result: str, query: str) -> float:
         """Calculate a relevance score for the result based on the query"""
@@ -164,26 +341,19 @@ class Worker:
         # Simple relevance calculation based on matching keywords
         relevance = 0.0
         
-        # Extract keywords from query
-        query_words = set(re.findall(r'\w+', query.lower()))
-        # Remove common Vietnamese stopwords
-        stopwords = {
-            'và', 'của', 'là', 'cho', 'trong', 'về', 'từ', 'với', 'đến', 'tại',
-            'một', 'các', 'những', 'này', 'đó', 'nên', 'khi', 'thì', 'được',
-            'bằng', 'có', 'đã', 'sẽ', 'còn', 'vẫn'
-        }
-        query_words = query_words - stopwords
+        # Extract keywords from query, without common Vietnamese stopwords
+        query_words = _query_keywords(query)
         
         # Count matching keywords in result
         result_lower = result.lower()
-        matches = sum(1 for word in query_words if word in result_lower)
+        matches = _count_keyword_matches(query_words, result_lower)
         
         # Basic relevance score calculation
         if query_words:
             relevance = matches / len(query_words)
         
         # Boost score if result contains numbers (likely factual information)
-        if re.search(r'\d+', result):
+        if _DIGIT_RE.search(result):
             relevance *= 1.2
             
         # Cap at 1.0
@@ -191,34 +361,26 @@ class Worker:
 
 class Orchestrator:
     """Orchestrator that coordinates tasks and workers"""
-    def __init__(self, api_key: Optional[str] = None, num_workers: int = 3):
+    def __init__(self, api_key: Optional[str] = None, num_workers: int = 3,
+                 executor: Optional[concurrent.futures.Executor] = None,
+                 max_concurrency: Optional[int] = None):
         self.api_key = api_key or os.environ.get("GEMINI_API_KEY", "")
+        self.executor = executor or get_executor()
+        self.max_concurrency = max_concurrency or MAX_CONCURRENT_TASKS
         self.tasks: List[Task] = []
         self.task_results: Dict[str, Any] = {}
         self.workers: List[Worker] = [
-            Worker(f"worker-{i}", api_key=self.api_key) for i in range(num_workers)
+            Worker(f"worker-{i}", api_key=self.api_key, executor=self.executor) for i in range(num_workers)
         ]
-        self.agent = GeminiAgent(api_key=self.api_key)
+        self.agent = get_agent(self.api_key)
         
     async def process_query(self, user_query: str, documents: List[str], file_sources: List[str]) -> str:
         """Process a query by distributing work among workers and synthesizing results"""
         start_time = time.time()
         logger.info(f"Orchestrator processing query: {user_query}")
         
-        # 1. Analyze query to understand information needs
-        query_analysis = await self._analyze_query(user_query)
-        logger.info(f"Query analysis: {query_analysis}")
-        
-        # 2. Create tasks from documents
-        tasks = self._create_tasks(user_query, documents, file_sources, query_analysis)
-        logger.info(f"Created {len(tasks)} tasks for query processing")
-        
-        # 3. Execute tasks concurrently using workers
-        completed_tasks = await self._execute_tasks(tasks)
-        
-        # 4. Filter and rank results
-        ranked_results = self._rank_results(completed_tasks, query_analysis)
-        logger.info(f"Ranked {len(ranked_results)} results from worker tasks")
+        # 1-4. Analyze the query, run the worker tasks and rank their results
+        query_analysis, ranked_results = await self._collect_ranked_results(user_query, documents, file_sources)
         
         # 5. Synthesize final response
         final_response = await self._synthesize_response(user_query, ranked_results, query_analysis)
@@ -240,13 +402,79 @@ class Orchestrator:
         
         return final_response
     
+    async def process_query_stream(self, user_query: str, documents: List[str], file_sources: List[str]):
+        """
+        Streaming variant of process_query: the synthesized answer is yielded as text
+        deltas while Gemini generates it. If the streamed answer turns out to say that
+        nothing was found, STREAM_RESET is yielded before the general knowledge answer
+        so the caller can discard the text it has already shown.
+        """
+        start_time = time.time()
+        logger.info(f"Orchestrator streaming query: {user_query}")
+        
+        query_analysis, ranked_results = await self._collect_ranked_results(user_query, documents, file_sources)
+        
+        if not ranked_results:
+            final_response = "Xin lỗi, tôi không tìm thấy thông tin liên quan đến câu hỏi của bạn trong các tài liệu hiện có."
+            try:
+                logger.info(f"No relevant information found in documents, using Gemini's general knowledge")
+                general_response = await self._generate_general_response(user_query)
+                if general_response and len(general_response) > 20:
+                    final_response = general_response
+            except Exception as e:
+                logger.error(f"Error generating general response: {e}")
+            yield final_response
+        else:
+            parts = []
+            async for delta in self._synthesize_response_stream(user_query, ranked_results, query_analysis):
+                parts.append(delta)
+                yield delta
+            
+            try:
+                if "không tìm thấy thông tin" in "".join(parts).lower():
+                    logger.info(f"No relevant information found in documents, using Gemini's general knowledge")
+                    general_response = await self._generate_general_response(user_query)
+                    if general_response and len(general_response) > 20:
+                        yield STREAM_RESET
+                        yield general_response
+            except Exception as e:
+                logger.error(f"Error generating general response: {e}")
+        
+        elapsed_time = time.time() - start_time
+        logger.info(f"Query streamed in {elapsed_time:.2f} seconds")
+    
+    async def _collect_ranked_results(self, user_query: str, documents: List[str], 
+                                      file_sources: List[str]) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        """Analyze the query, run the worker tasks over the documents and rank their results"""
+        # 1. Analyze query to understand information needs; the per-file contexts do not
+        # depend on the analysis, so they are prepared while the Gemini call is in flight
+        query_analysis, file_contexts = await asyncio.gather(
+            self._analyze_query(user_query),
+            asyncio.get_running_loop().run_in_executor(
+                self.executor, self._prepare_file_contexts, documents, file_sources
+            ),
+        )
+        logger.info(f"Query analysis: {query_analysis}")
+        
+        # 2. Create tasks from documents
+        tasks = self._create_tasks(user_query, file_contexts, query_analysis)
+        logger.info(f"Created {len(tasks)} tasks for query processing")
+        
+        # 3. Execute tasks concurrently using workers
+        completed_tasks = await self._execute_tasks(tasks)
+        
+        # 4. Filter and rank results
+        ranked_results = self._rank_results(completed_tasks, query_analysis)
+        logger.info(f"Ranked {len(ranked_results)} results from worker tasks")
+        
+        return query_analysis, ranked_results
+    
     async def _analyze_query(self, query: str) -> Dict[str, Any]:
         """Analyze the query to understand information needs"""
         # Execute in thread pool to avoid blocking
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            analysis = await asyncio.get_event_loop().run_in_executor(
-                executor, self.agent._analyze_query, query
-            )
+        analysis = await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.agent._analyze_query, query
+        )
         
         return analysis or {
             "chủ_đề": "không xác định",
@@ -254,91 +482,92 @@ class Orchestrator:
             "file_ưu_tiên": ""
         }
     
-    def _create_tasks(self, query: str, documents: List[str], file_sources: List[str], 
-                       query_analysis: Dict[str, Any]) -> List[Task]:
-        """Create tasks from documents based on query analysis"""
-        tasks = []
-        
-        # Get prioritized file order based on query analysis
-        file_priorities = self.agent._determine_file_priority(query_analysis)
-        
+    def _prepare_file_contexts(self, documents: List[str], file_sources: List[str]) -> Dict[str, str]:
+        """Group documents by source file and prepare one size-limited context per file"""
         # Create a mapping of files to documents for easier lookup
-        file_docs_map = {}
-        for i, (doc, source) in enumerate(zip(documents, file_sources)):
-            if not source:  # Skip if source is None or empty
-                continue
-            if source not in file_docs_map:
-                file_docs_map[source] = []
-            file_docs_map[source].append(doc)
-        
-        # Create tasks for each source file in priority order
-        task_id = 0
-        for file_name in file_priorities:
-            if file_name in file_docs_map:
-                # Combine all documents from this file
-                combined_context = "\n\n---\n\n".join(file_docs_map[file_name])
-                
-                # Process the context for better handling
-                processed_context = prepare_vietnamese_context(combined_context)
-                
-                # Limit context size for effective processing
-                if len(processed_context) > 28000:
-                    processed_context = processed_context[:28000] + "\n\n...(truncated for length)..."
-                
-                # Create a task for this file
-                task = Task(
-                    task_id=f"task-{task_id}", 
-                    query=query, 
-                    context=processed_context,
-                    source_file=file_name
-                )
-                tasks.append(task)
-                task_id += 1
+        file_docs_map = defaultdict(list)
+        for doc, source in zip(documents, file_sources):
+            if source:  # Skip if source is None or empty
+                file_docs_map[source].append(doc)
         
-        # Add tasks for any remaining files not in priorities
+        file_contexts = {}
         for file_name, docs in file_docs_map.items():
-            if file_name not in file_priorities:
-                combined_context = "\n\n---\n\n".join(docs)
-                processed_context = prepare_vietnamese_context(combined_context)
-                
-                if len(processed_context) > 28000:
-                    processed_context = processed_context[:28000] + "\n\n...(truncated for length)..."
-                
-                task = Task(
-                    task_id=f"task-{task_id}", 
-                    query=query, 
-                    context=processed_context,
-                    source_file=file_name
-                )
-                tasks.append(task)
-                task_id += 1
+            # Combine all documents from this file and process the context for better handling
+            processed_context = prepare_vietnamese_context("\n\n---\n\n".join(docs))
+            
+            # Limit context size for effective processing
+            if len(processed_context) > 28000:
+                processed_context = processed_context[:28000] + "\n\n...(truncated for length)..."
+            file_contexts[file_name] = processed_context
         
-        return tasks
+        return file_contexts
+    
+    def _create_tasks(self, query: str, file_contexts: Dict[str, str], 
+                       query_analysis: Dict[str, Any]) -> List[Task]:
+        """Create one task per prepared file context, in the file priority order of the query analysis"""
+        # Get prioritized file order based on query analysis
+        file_priorities = self.agent._determine_file_priority(query_analysis)
+        
+        # Files in priority order first, then any remaining files not in priorities
+        priority_files = set(file_priorities)
+        ordered_files = [file_name for file_name in file_priorities if file_name in file_contexts]
+        ordered_files.extend(file_name for file_name in file_contexts if file_name not in priority_files)
+        
+        return [
+            Task(
+                task_id=f"task-{task_id}", 
+                query=query, 
+                context=file_contexts[file_name],
+                source_file=file_name
+            )
+            for task_id, file_name in enumerate(ordered_files)
+        ]
     
     async def _execute_tasks(self, tasks: List[Task]) -> List[Task]:
-        """Execute tasks concurrently using available workers"""
-        # Use round-robin worker assignment
-        num_workers = len(self.workers)
-        tasks_per_worker = {worker.worker_id: [] for worker in self.workers}
-        
-        for i, task in enumerate(tasks):
-            worker_idx = i % num_workers
-            tasks_per_worker[self.workers[worker_idx].worker_id].append(task)
-        
-        # Create and gather all worker tasks
-        worker_jobs = []
-        for worker in self.workers:
-            worker_tasks = tasks_per_worker[worker.worker_id]
-            if worker_tasks:
-                # Process each task for this worker
-                for task in worker_tasks:
-                    worker_jobs.append(worker.process_task(task))
-        
-        # Run all tasks concurrently
-        if worker_jobs:
-            completed_tasks = await asyncio.gather(*worker_jobs)
-            return completed_tasks
-        return []
+        """Execute tasks concurrently, with at most max_concurrency Gemini calls in flight"""
+        if not tasks:
+            return []
+        
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        
+        async def run(worker: Worker, task: Task) -> Task:
+            async with semaphore:
+                return await worker.process_task(task)
+        
+        async def run_batch(worker: Worker, batch: List[Task]):
+            async with semaphore:
+                leftovers = await worker.process_batch(batch)
+            # Files the batched answer did not cover get their own extraction call
+            await asyncio.gather(*(run(worker, task) for task in leftovers))
+        
+        # Workers only label the calls in the logs; the semaphore bounds the concurrency
+        batches = self._batch_tasks(tasks)
+        results = await asyncio.gather(
+            *(run_batch(self.workers[i % len(self.workers)], batch) for i, batch in enumerate(batches)),
+            return_exceptions=True
+        )
+        
+        # A batch that failed outside the workers must not cancel or hide its siblings
+        for batch, result in zip(batches, results):
+            if isinstance(result, BaseException):
+                logger.error(f"Tasks {[task.task_id for task in batch]} failed: {result}")
+                for task in batch:
+                    if task.status not in ("completed", "failed"):
+                        task.mark_failed(result)
+        return tasks
+    
+    def _batch_tasks(self, tasks: List[Task]) -> List[List[Task]]:
+        """Greedily group tasks, in priority order, into batches of at most BATCH_MAX_CHARS of context"""
+        batches = []
+        batch_chars = 0
+        for task in tasks:
+            if batches and batch_chars + len(task.context) <= BATCH_MAX_CHARS:
+                batches[-1].append(task)
+                batch_chars += len(task.context)
+            else:
+                batches.append([task])
+                batch_chars = len(task.context)
+        return batches
     
     def _rank_results(self, completed_tasks: List[Task], query_analysis: Dict[str, Any]) -> List[Dict[str, Any]]:
         """Rank and filter results based on relevance to query"""
@@ -363,12 +592,9 @@ class Orchestrator:
         
         return ranked_results
     
-    async def _synthesize_response(self, query: str, ranked_results: List[Dict[str, Any]], 
-                                 query_analysis: Dict[str, Any]) -> str:
-        """Synthesize a final response from ranked results"""
-        if not ranked_results:
-            return f"Xin lỗi, tôi không tìm thấy thông tin liên quan đến câu hỏi của bạn trong các tài liệu hiện có."
-        
+    def _build_synthesis_payload(self, query: str, ranked_results: List[Dict[str, Any]], 
+                                 query_analysis: Dict[str, Any]) -> Tuple[Dict[str, Any], str]:
+        """Build the Gemini request for synthesizing ranked results, plus the source citation"""
         # Extract information from top results (limit to most relevant)
         result_texts = []
         sources = []
@@ -381,11 +607,9 @@ class Orchestrator:
             result_texts.append(result["content"])
             
             # Track source files for citation
-            file_name = result["source_file"]
             # Clean up UUID prefixes if present
-            if '_' in file_name and any(c for c in file_name if c == '-'):
-                file_name = file_name.split('_', 1)[1] if '_' in file_name else file_name
-                
+            file_name = strip_uuid_prefix(result["source_file"])
+            
             if file_name not in sources:
                 sources.append(file_name)
         
@@ -431,31 +655,43 @@ class Orchestrator:
         Trả lời câu hỏi dựa trên thông tin đã tổng hợp.
         """
         
-        # Execute in thread pool to avoid blocking
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            payload = {
-                "contents": [
-                    {
-                        "role": "user",
-                        "parts": [{"text": synthesis_prompt}]
-                    }
-                ],
-                "generationConfig": {
-                    "temperature": 0.2,
-                    "topP": 0.95,
-                    "topK": 40,
-                    "maxOutputTokens": 2048
+        payload = {
+            "contents": [
+                {
+                    "role": "user",
+                    "parts": [{"text": synthesis_prompt}]
                 }
+            ],
+            "generationConfig": {
+                "temperature": 0.2,
+                "topP": 0.95,
+                "topK": 40,
+                "maxOutputTokens": 2048
             }
-            
-            # Use the agent's API call methods directly
-            response_future = asyncio.get_event_loop().run_in_executor(
-                executor,
-                lambda: self.agent._call_api(payload)
-            )
-            
-            response_json = await response_future
-            final_response = self.agent._process_response(response_json)
+        }
+        return payload, source_citation
+    
+    async def _synthesize_response(self, query: str, ranked_results: List[Dict[str, Any]], 
+                                 query_analysis: Dict[str, Any]) -> str:
+        """Synthesize a final response from ranked results"""
+        if not ranked_results:
+            return f"Xin lỗi, tôi không tìm thấy thông tin liên quan đến câu hỏi của bạn trong các tài liệu hiện có."
+        
+        payload, source_citation = self._build_synthesis_payload(query, ranked_results, query_analysis)
+        
+        # The prompt holds the query, topic and every result, so it identifies the answer exactly
+        cache_key = _digest(payload["contents"][0]["parts"][0]["text"])
+        final_response = _synthesis_cache.get(cache_key)
+        if final_response is not None:
+            return final_response
+        
+        # Execute in thread pool to avoid blocking, using the agent's API call methods directly
+        response_json = await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.agent._call_api, payload
+        )
+        final_response = self.agent._process_response(response_json)
+        if final_response:
+            _synthesis_cache.put(cache_key, final_response)
         
         # If synthesis failed, create a basic response from the top result
         if not final_response:
@@ -465,6 +701,48 @@ class Orchestrator:
                 return f"Xin lỗi, tôi không thể tổng hợp thông tin để trả lời câu hỏi của bạn."
         
         return final_response
+    
+    async def _synthesize_response_stream(self, query: str, ranked_results: List[Dict[str, Any]], 
+                                        query_analysis: Dict[str, Any]):
+        """Synthesize a final response from ranked results, yielding text deltas as Gemini produces them"""
+        payload, source_citation = self._build_synthesis_payload(query, ranked_results, query_analysis)
+        
+        cache_key = _digest(payload["contents"][0]["parts"][0]["text"])
+        cached_response = _synthesis_cache.get(cache_key)
+        if cached_response is not None:
+            yield cached_response
+            return
+        
+        loop = asyncio.get_running_loop()
+        parts = []
+        # The HTTP stream is read with blocking calls, so pull each chunk in a thread;
+        # the chunks are awaited one at a time, so the generator never runs concurrently
+        opened = []
+        chunks = self.agent._call_api_stream(payload, opened)
+        pending = None
+        try:
+            while True:
+                pending = self.executor.submit(next, chunks, None)
+                delta = await asyncio.wrap_future(pending)
+                if delta is None:
+                    break
+                parts.append(delta)
+                yield delta
+        finally:
+            if pending is not None and not pending.done():
+                # Cancelled while a chunk is still being read: abort the HTTP read, and only
+                # close the generator once next() has returned, as a running one cannot be closed
+                for response in opened:
+                    response.close()
+                pending.add_done_callback(lambda _: chunks.close())
+            else:
+                await loop.run_in_executor(self.executor, chunks.close)
+        
+        if parts:
+            _synthesis_cache.put(cache_key, "".join(parts))
+        else:
+            # If synthesis produced nothing, fall back to the top result as in _synthesize_response
+            yield f"{ranked_results[0]['content']}\n\n<small><i>Thông tin được tìm thấy trong: {source_citation}</i></small>"
         
     async def _generate_general_response(self, query: str) -> str:
         """Generate a response using Gemini's general knowledge when no relevant information is found in documents"""
@@ -483,60 +761,57 @@ class Orchestrator:
         
         # Execute in thread pool to avoid blocking
         try:
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                payload = {
-                    "contents": [
-                        {
-                            "role": "user",
-                            "parts": [{"text": general_prompt}]
-                        }
-                    ],
-                    "generationConfig": {
-                        "temperature": 0.3,
-                        "topP": 0.95,
-                        "topK": 40,
-                        "maxOutputTokens": 1024
+            payload = {
+                "contents": [
+                    {
+                        "role": "user",
+                        "parts": [{"text": general_prompt}]
                     }
+                ],
+                "generationConfig": {
+                    "temperature": 0.3,
+                    "topP": 0.95,
+                    "topK": 40,
+                    "maxOutputTokens": 1024
                 }
-                
-                # Use the agent's API call methods directly
-                response_future = asyncio.get_event_loop().run_in_executor(
-                    executor,
-                    lambda: self.agent._call_api(payload)
-                )
-                
-                response_json = await response_future
-                response_text = self.agent._process_response(response_json) or ""
+            }
             
-                # Add a disclaimer to make it clear this is not from the documents
-                if not response_text and len(response_text) > 10 or not isinstance(response_text, str):
-                    if not "<h4>" in response_text[:100].lower():
-                        response_text = f"<h4>Thông tin chung</h4>\n{response_text}"
-                    if not "không tìm thấy" in response_text.lower():
-                        response_text = f"<p><i>Xin lỗi, tôi không tìm thấy thông tin cụ thể về câu hỏi này trong các tài liệu của trường.</i></p>\n{response_text}"
-                    if not "<small>" in response_text[-200:].lower():
-                        response_text += "\n\n<small><i>Lưu ý: Câu trả lời này dựa trên kiến thức chung, không phải từ tài liệu chính thức của trường.</i></small>"
-                
-                return response_text
+            # Use the agent's API call methods directly
+            response_json = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.agent._call_api, payload
+            )
+            response_text = self.agent._process_response(response_json) or ""
+            
+            # Add a disclaimer to make it clear this is not from the documents
+            if not response_text and len(response_text) > 10 or not isinstance(response_text, str):
+                if not "<h4>" in response_text[:100].lower():
+                    response_text = f"<h4>Thông tin chung</h4>\n{response_text}"
+                if not "không tìm thấy" in response_text.lower():
+                    response_text = f"<p><i>Xin lỗi, tôi không tìm thấy thông tin cụ thể về câu hỏi này trong các tài liệu của trường.</i></p>\n{response_text}"
+                if not "<small>" in response_text[-200:].lower():
+                    response_text += "\n\n<small><i>Lưu ý: Câu trả lời này dựa trên kiến thức chung, không phải từ tài liệu chính thức của trường.</i></small>"
+            
+            return response_text
         except Exception as e:
             logger.error(f"Error generating general response: {e}")
             return ""
 
+def is_technical_query(user_query: str) -> bool:
+    """Check if query is likely about programming, technical topic, or others unrelated to admissions"""
+    query_words = user_query.lower().split()
+    technical_terms = ['python', 'code', 'function', 'programming', 'javascript', 'hàm', 'code', 'lập trình', 'web', 'algorithm', 'thuật toán']
+    
+    # Check if query contains technical keywords
+    return any(term in query_words for term in technical_terms)
+
 async def orchestrate_response(user_query: str, documents: List[str], file_sources: List[str]) -> str:
     """Main entry point for orchestrating document search and response generation"""
     try:
         # Create the orchestrator
         orchestrator = Orchestrator()
         
-        # Check if query is likely about programming, technical topic, or others unrelated to admissions
-        query_words = user_query.lower().split()
-        technical_terms = ['python', 'code', 'function', 'programming', 'javascript', 'hàm', 'code', 'lập trình', 'web', 'algorithm', 'thuật toán']
-        
-        # Check if query contains technical keywords
-        is_technical_query = any(term in query_words for term in technical_terms)
-        
         # If query is technical or clearly not about university admissions, use general knowledge directly
-        if is_technical_query:
+        if is_technical_query(user_query):
             logger.info(f"Technical query detected, using Gemini's general knowledge: {user_query}")
             general_response = await orchestrator._generate_general_response(user_query)
             return general_response
@@ -548,3 +823,27 @@ async def orchestrate_response(user_query: str, documents: List[str], file_sourc
     except Exception as e:
         logger.error(f"Error in orchestration: {e}")
         return f"Xin lỗi, đã xảy ra lỗi khi xử lý yêu cầu: {str(e)}"
+
+async def orchestrate_response_stream(user_query: str, documents: List[str], file_sources: List[str]):
+    """
+    Streaming variant of orchestrate_response that yields the answer as text deltas.
+    The analysis and worker phases still have to finish first, but the synthesized
+    answer is streamed from Gemini as it is generated. A STREAM_RESET item means the
+    text yielded so far should be discarded and replaced by what follows.
+    """
+    try:
+        orchestrator = Orchestrator()
+        
+        if is_technical_query(user_query):
+            logger.info(f"Technical query detected, using Gemini's general knowledge: {user_query}")
+            general_response = await orchestrator._generate_general_response(user_query)
+            if general_response:
+                yield general_response
+            return
+        
+        async for delta in orchestrator.process_query_stream(user_query, documents, file_sources):
+            yield delta
+    except Exception as e:
+        logger.error(f"Error in orchestration: {e}")
+        yield STREAM_RESET
+        yield f"Xin lỗi, đã xảy ra lỗi khi xử lý yêu cầu: {str(e)}"
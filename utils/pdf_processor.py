@@ -1,4 +1,5 @@
 import PyPDF2
+import os
 import re
 import logging
 
@@ -207,3 +208,32 @@ def chunk_text(text, chunk_size=5000, overlap=500, file_source=None):
         logger.debug(f"Average chunk size: {sum(len(c) for c in chunks) / len(chunks)} characters")
     
     return chunks
+
+def extract_and_chunk_pdf(pdf_path):
+    """
+    Extract and chunk a single PDF. Kept at module level so it can be run
+    in a worker process without any Flask globals.
+    
+    Args:
+        pdf_path (str): Path to the PDF file
+        
+    Returns:
+        list: Source-tagged chunks (the full text is not sent back to the caller)
+    """
+    text = extract_text_from_pdf(pdf_path)
+    return chunk_text(text, file_source=os.path.basename(pdf_path))
+
+def split_source_tag(chunk):
+    """
+    Split a chunk produced by chunk_text into its source file and content
+    
+    Args:
+        chunk (str): Chunk, optionally starting with a SOURCE_FILE tag line
+        
+    Returns:
+        tuple: (source file name or None, content without the tag line)
+    """
+    if not chunk.startswith("SOURCE_FILE:"):
+        return None, chunk
+    source_line, _, content = chunk.partition('\n')
+    return source_line[len("SOURCE_FILE:"):].strip(), content
@@ -3,25 +3,111 @@ import logging
 import re
 import os
 import pickle
+import threading
 import torch
+from multiprocessing import shared_memory
 from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
+from .embedding_cache import cached_encoder
+from .pdf_processor import split_source_tag
 
 logger = logging.getLogger(__name__)
 
+# Stored rows are upcast to float32 this many at a time when scoring, so a search
+# only needs a small per-thread scratch block instead of a float32 copy of the matrix
+SIMILARITY_BLOCK_ROWS = 2048
+
 class TransformerVectorStore:
     """
     A vector store using Sentence Transformers for document similarity
     Provides more semantic understanding compared to TF-IDF
     """
     
-    def __init__(self, model_name="bkai-foundation-models/vietnamese-bi-encoder"):
-        self.documents = []
+    def __init__(self, model_name="bkai-foundation-models/vietnamese-bi-encoder", backend=None):
+        self.documents = []  # Chunk contents, without the SOURCE_FILE tag line
         self.file_sources = {}  # Document index -> file source mapping
         self.file_indices = {}  # File source -> list of document indices
         self.file_categories = {}  # Categorization of files by type
-        self.model = SentenceTransformer(model_name)
+        # "torch" (FP32) or "onnx-int8" (dynamically quantized ONNX, faster on CPU)
+        self.backend = backend or os.environ.get("EMBEDDING_BACKEND", "torch")
+        if self.backend == "onnx-int8":
+            self.model = self._load_quantized_onnx(model_name)
+        else:
+            self.model = SentenceTransformer(model_name)
+        # Opt-in: store embeddings as int8 with a per-row scale instead of float16
+        self.quantize_int8 = os.environ.get("EMBEDDING_QUANTIZATION") == "int8"
         self.vectors = None
+        self.vector_scales = None  # Per-row float32 scales when vectors are int8
+        self._shm = None  # Shared memory block backing self.vectors, if any
+        self._shm_owner_pid = None
+        self._scratch = threading.local()  # Per-thread float32 block reused by _similarities
+        # LRU cache of query embeddings so repeated queries skip the forward pass
+        self._embed = cached_encoder(self._encode_query, maxsize=2048)
+
+    @staticmethod
+    def _load_quantized_onnx(model_name, cache_dir="vector_store_data/onnx"):
+        """
+        Load an int8 dynamically quantized ONNX export of the model, exporting and
+        quantizing it on first use (requires sentence-transformers[onnx])
+        """
+        from sentence_transformers import export_dynamic_quantized_onnx_model
+        
+        quantized_file = "model_qint8_avx512_vnni.onnx"
+        local_dir = os.path.join(cache_dir, model_name.replace("/", "__"))
+        if not os.path.exists(os.path.join(local_dir, "onnx", quantized_file)):
+            logger.info(f"Exporting {model_name} to quantized ONNX in {local_dir}")
+            model = SentenceTransformer(model_name, backend="onnx")
+            model.save(local_dir)
+            export_dynamic_quantized_onnx_model(model, "avx512_vnni", local_dir)
+        return SentenceTransformer(
+            local_dir, backend="onnx", model_kwargs={"file_name": f"onnx/{quantized_file}"}
+        )
+
+    def _encode_query(self, text):
+        with torch.no_grad():
+            return self.model.encode([text], convert_to_numpy=True, normalize_embeddings=True)
+
+    def embed_query(self, query):
+        """
+        Return the (cached) embedding of a query with shape (1, dim)
+        """
+        return self._embed(query)
+
+    @staticmethod
+    def _vectors_path(filepath):
+        """Path of the .npy file holding the embedding matrix next to the pickle"""
+        return os.path.splitext(filepath)[0] + ".npy"
+
+    @staticmethod
+    def _scales_path(filepath):
+        """Path of the .npy file holding the int8 row scales next to the pickle"""
+        return os.path.splitext(filepath)[0] + ".scales.npy"
+
+    def _prepare_vectors(self, vectors):
+        """
+        Normalize embeddings to unit length, so cosine similarity becomes a single
+        dot product, and convert them to the storage format: a contiguous float16
+        matrix, or int8 rows with a float32 scale each when quantize_int8 is set
+        
+        Returns:
+            tuple: (matrix, per-row scales or None)
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        vectors = vectors / norms
+        if not self.quantize_int8:
+            return np.ascontiguousarray(vectors.astype(np.float16)), None
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        quantized = np.rint(vectors / scales[:, None]).astype(np.int8)
+        return np.ascontiguousarray(quantized), scales.astype(np.float32)
+
+    def _dequantized_vectors(self):
+        """The stored embedding matrix as float32, undoing any int8 scaling"""
+        vectors = np.asarray(self.vectors, dtype=np.float32)
+        if self.vector_scales is not None:
+            vectors = vectors * self.vector_scales[:, None]
+        return vectors
 
     def save_to_disk(self, filepath):
         data = {
@@ -29,24 +115,116 @@ class TransformerVectorStore:
             "file_sources": self.file_sources,
             "file_indices": self.file_indices,
             "file_categories": self.file_categories,
-            "vectors": self.vectors,
+            "embedding_backend": self.backend,
         }
         os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        with open(filepath, "wb") as f:
-            pickle.dump(data, f)
+        # Write each file next to its target and swap it in with os.replace, so a crash
+        # never leaves a half-written file and a memory-mapped old matrix stays valid.
+        # The pickle goes last since load_from_disk starts from it.
+        if self.vectors is not None:
+            self._replace_file(self._vectors_path(filepath), lambda f: np.save(f, self.vectors))
+        if self.vector_scales is not None:
+            self._replace_file(self._scales_path(filepath), lambda f: np.save(f, self.vector_scales))
+        self._replace_file(filepath, lambda f: pickle.dump(data, f))
+
+    @staticmethod
+    def _replace_file(path, write):
+        """Atomically replace path with the bytes written by write(file)"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
 
     def load_from_disk(self, filepath):
         if not os.path.exists(filepath):
             return False
         with open(filepath, "rb") as f:
             data = pickle.load(f)
-        self.documents = data["documents"]
+        # Embeddings from another backend are not comparable with our query vectors
+        stored_backend = data.get("embedding_backend", "torch")
+        if stored_backend != self.backend:
+            logger.warning(f"Vector store at {filepath} was built with '{stored_backend}' embeddings, not '{self.backend}'")
+            return False
+        # Older stores keep the SOURCE_FILE tag inside each document
+        self.documents = [split_source_tag(doc)[1] for doc in data["documents"]]
         self.file_sources = data["file_sources"]
         self.file_indices = data["file_indices"]
         self.file_categories = data["file_categories"]
-        self.vectors = data["vectors"]
+
+        vectors_path = self._vectors_path(filepath)
+        self.vector_scales = None
+        if os.path.exists(vectors_path):
+            # Memory-map the matrix instead of reading it all into RAM
+            self.vectors = np.load(vectors_path, mmap_mode="r")
+            if self.vectors.dtype == np.int8:
+                self.vector_scales = np.load(self._scales_path(filepath))
+        elif data.get("vectors") is not None:
+            # Older pickles store the float32 matrix inline
+            self.vectors, self.vector_scales = self._prepare_vectors(data["vectors"])
+        else:
+            self.vectors = None
+        
+        if self.vectors is not None and len(self.vectors) != len(self.documents):
+            logger.warning(f"Vector store at {filepath} has {len(self.documents)} documents but {len(self.vectors)} vectors")
+            return False
+        
+        # Convert a matrix saved with the other storage format
+        if self.vectors is not None and (self.vectors.dtype == np.int8) != self.quantize_int8:
+            self.vectors, self.vector_scales = self._prepare_vectors(self._dequantized_vectors())
         return True
 
+    def _similarities(self, query_vector, indices=None):
+        """
+        Cosine similarities between the query and the stored documents
+
+        Args:
+            query_vector (np.ndarray): Unit-length query embedding with shape (1, dim)
+            indices (list): Document indices to score, or None for all documents
+
+        Returns:
+            np.ndarray: Similarity score per document
+        """
+        query = np.asarray(query_vector, dtype=np.float32).reshape(-1)
+        vectors, scales = self.vectors, self.vector_scales
+        if indices is not None:
+            indices = np.asarray(indices, dtype=np.intp)
+        count = len(vectors) if indices is None else len(indices)
+        similarities = np.empty(count, dtype=np.float32)
+        # numpy has no BLAS kernel for float16/int8, so rows are upcast block by block
+        block = self._scratch_block(min(count, SIMILARITY_BLOCK_ROWS), vectors.shape[1])
+        for start in range(0, count, SIMILARITY_BLOCK_ROWS):
+            stop = min(start + SIMILARITY_BLOCK_ROWS, count)
+            positions = slice(start, stop) if indices is None else indices[start:stop]
+            rows = block[:stop - start]
+            rows[...] = vectors[positions]
+            np.dot(rows, query, out=similarities[start:stop])
+            if scales is not None:
+                # int8 rows: the dot product of the raw codes times the row scale
+                similarities[start:stop] *= scales[positions]
+        return similarities
+
+    def _scratch_block(self, rows, dim):
+        """This thread's float32 scratch block, grown only when a larger one is needed"""
+        block = getattr(self._scratch, "block", None)
+        if block is None or block.shape[0] < rows or block.shape[1] != dim:
+            block = np.empty((rows, dim), dtype=np.float32)
+            self._scratch.block = block
+        return block
+
+    @staticmethod
+    def _top_k(similarities, k, threshold):
+        """
+        Positions of the k highest scores at or above the threshold, best first.
+        Partitions in O(n) and only sorts the k candidates.
+        """
+        if k <= 0 or len(similarities) == 0:
+            return np.array([], dtype=np.intp)
+        if k < len(similarities):
+            top = np.argpartition(-similarities, k - 1)[:k]
+        else:
+            top = np.arange(len(similarities))
+        top = top[np.argsort(-similarities[top])]
+        return top[similarities[top] >= threshold]
 
     def clear(self):
         """
@@ -57,7 +235,76 @@ class TransformerVectorStore:
         self.file_indices = {}
         self.file_categories = {}
         self.vectors = None
+        self.vector_scales = None
+        self.release_shared_vectors()
         logger.info("Transformer vector store cleared")
+
+    def remove_file(self, file_source):
+        """
+        Remove all documents of a source file, e.g. before re-indexing a modified PDF
+        
+        Args:
+            file_source (str): Source file name to remove
+        """
+        removed = self.file_indices.get(file_source)
+        if not removed:
+            return
+        keep = np.ones(len(self.documents), dtype=bool)
+        keep[removed] = False
+        
+        # Old index -> new index for the documents that stay
+        new_positions = np.cumsum(keep) - 1
+        self.documents = [doc for doc, kept in zip(self.documents, keep) if kept]
+        self.file_sources = {
+            int(new_positions[idx]): source
+            for idx, source in self.file_sources.items() if keep[idx]
+        }
+        self.file_indices = {}
+        for idx, source in sorted(self.file_sources.items()):
+            self.file_indices.setdefault(source, []).append(idx)
+        self.file_categories.pop(file_source, None)
+        
+        if self.vectors is not None:
+            self.vectors = np.ascontiguousarray(self.vectors[keep])
+            self.release_shared_vectors()
+        if self.vector_scales is not None:
+            self.vector_scales = self.vector_scales[keep]
+        logger.info(f"Removed {len(removed)} documents from source '{file_source}'")
+
+    def share_vectors(self):
+        """
+        Move the embedding matrix into shared memory so worker processes forked
+        after this call (e.g. gunicorn --preload) map the same pages instead of
+        each holding a private copy. Memory-mapped matrices are already shared
+        through the page cache and are left as they are.
+        
+        Returns:
+            str: Name of the shared memory block, or None if nothing was shared
+        """
+        if self.vectors is None or isinstance(self.vectors, np.memmap) or self._shm is not None:
+            return None
+        shm = shared_memory.SharedMemory(create=True, size=max(self.vectors.nbytes, 1))
+        shared = np.ndarray(self.vectors.shape, dtype=self.vectors.dtype, buffer=shm.buf)
+        shared[:] = self.vectors
+        self.vectors = shared
+        self._shm = shm
+        self._shm_owner_pid = os.getpid()
+        logger.info(f"Moved {shm.size} bytes of embeddings to shared memory '{shm.name}'")
+        return shm.name
+
+    def release_shared_vectors(self):
+        """
+        Unlink the shared memory block; only the creating process removes it
+        """
+        if self._shm is None:
+            return
+        if self._shm_owner_pid == os.getpid():
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
+        self._shm = None
+        self._shm_owner_pid = None
         
     def add_documents(self, documents, file_source=None):
         """
@@ -101,7 +348,8 @@ class TransformerVectorStore:
             except Exception as e:
                 logger.error(f"Error extracting source from tagged document: {e}")
         
-        # Add new documents
+        # Add new documents; the source lives in file_sources, not in the text
+        documents = [split_source_tag(doc)[1] for doc in documents]
         self.documents.extend(documents)
         
         # Track document indices for each file source
@@ -118,17 +366,65 @@ class TransformerVectorStore:
             
             logger.debug(f"Tracked {end_idx - start_idx} documents from source '{file_source}'")
         
-        # Compute embeddings if we have documents
-        if self.documents:
-            try:
-                # Create embeddings using the sentence transformer model
-                with torch.no_grad():
-                    self.vectors = self.model.encode(self.documents, convert_to_numpy=True)
-                logger.info(f"Added {len(documents)} documents to transformer vector store. Total: {len(self.documents)}")
-            except Exception as e:
-                logger.error(f"Error creating embeddings with transformer model: {e}")
+        # Embed only the new documents and append them to the matrix
+        try:
+            self._append_vectors(*self._encode_documents(documents))
+            logger.info(f"Added {len(documents)} documents to transformer vector store. Total: {len(self.documents)}")
+        except Exception as e:
+            logger.error(f"Error creating embeddings with transformer model: {e}")
+    
+    def add_documents_batch(self, documents, file_sources):
+        """
+        Add documents from several source files with a single batched encode
+        
+        Args:
+            documents (list): List of text documents to add
+            file_sources (list): Source file name for each document
+        """
+        if not documents:
+            logger.warning("No documents to add to vector store")
+            return
+        
+        start_idx = len(self.documents)
+        documents = [split_source_tag(doc)[1] for doc in documents]
+        self.documents.extend(documents)
+        
+        # Track document indices for each file source
+        for offset, file_source in enumerate(file_sources):
+            if not file_source:
+                continue
+            idx = start_idx + offset
+            self.file_sources[idx] = file_source
+            self.file_indices.setdefault(file_source, []).append(idx)
+        
+        try:
+            self._append_vectors(*self._encode_documents(documents))
+            logger.info(f"Added {len(documents)} documents from {len(self.file_indices)} sources to transformer vector store. Total: {len(self.documents)}")
+        except Exception as e:
+            logger.error(f"Error creating embeddings with transformer model: {e}")
+    
+    def _encode_documents(self, documents):
+        """
+        Embed documents in batches as unit-length vectors in the storage format
+        """
+        with torch.no_grad():
+            vectors = self.model.encode(
+                documents,
+                batch_size=64,
+                show_progress_bar=False,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+            )
+        return self._prepare_vectors(vectors)
+    
+    def _append_vectors(self, vectors, scales=None):
+        if self.vectors is None or len(self.vectors) == 0:
+            self.vectors = vectors
+            self.vector_scales = scales
         else:
-            logger.warning("No documents in vector store after attempted addition")
+            self.vectors = np.ascontiguousarray(np.vstack([self.vectors, vectors]))
+            if scales is not None:
+                self.vector_scales = np.concatenate([self.vector_scales, scales])
         
     def similarity_search(self, query, k=5, threshold=0.05):
         """
@@ -140,11 +436,12 @@ class TransformerVectorStore:
             threshold (float): Minimum similarity score to include a document
             
         Returns:
-            list: Top k most similar documents
+            list: Top k most similar documents as (file source, content) tuples;
+                the source is None for fallback messages
         """
         if not self.documents or self.vectors is None:
             logger.warning("No documents in transformer vector store")
-            return ["No knowledge base available. Please upload PDF files."]
+            return [(None, "No knowledge base available. Please upload PDF files.")]
         
         try:
             # Process the query to match the document format
@@ -184,45 +481,34 @@ class TransformerVectorStore:
                 
                 if remaining_indices:
                     # Encode the query using the transformer model
-                    with torch.no_grad():
-                        query_vector = self.model.encode([query], convert_to_numpy=True)
-                    
-                    # Get vectors for remaining documents
-                    remaining_vectors = self.vectors[remaining_indices]
-                    
-                    # Calculate similarities
-                    similarities = cosine_similarity(query_vector, remaining_vectors).flatten()
+                    query_vector = self._embed(query)
                     
-                    # Sort by similarity
-                    sorted_idx = np.argsort(similarities)[::-1]
+                    # Calculate similarities against the remaining documents
+                    similarities = self._similarities(query_vector, remaining_indices)
                     
-                    # Add until we have k results or reach the threshold
-                    for i in sorted_idx:
-                        if similarities[i] >= threshold:
-                            doc_idx = remaining_indices[i]
-                            if doc_idx not in all_indices:
-                                all_indices.append(doc_idx)
-                                all_results.append(self.documents[doc_idx])
-                                all_scores.append(similarities[i])
-                                
-                                if len(all_results) >= k:
-                                    break
+                    # Add the best remaining matches above the threshold until we have k results
+                    for i in self._top_k(similarities, k - len(all_results), threshold):
+                        doc_idx = remaining_indices[i]
+                        all_indices.append(doc_idx)
+                        all_results.append(self.documents[doc_idx])
+                        all_scores.append(similarities[i])
             
             # 4. RETURN RESULTS OR FALLBACK
             if not all_results:
                 logger.info(f"No documents found with similarity above threshold {threshold} for query: {query}")
-                return ["Tôi không tìm thấy thông tin cụ thể về câu hỏi của bạn trong cơ sở dữ liệu của tôi."]
+                return [(None, "Tôi không tìm thấy thông tin cụ thể về câu hỏi của bạn trong cơ sở dữ liệu của tôi.")]
             
             # Log the file sources for all results
-            for i, (doc, idx, score) in enumerate(zip(all_results, all_indices, all_scores)):
-                file_source = self.file_sources.get(idx, "Unknown")
-                logger.debug(f"Result {i+1} from '{file_source}' (score: {score:.4f}): {doc[:200]}...")
+            if logger.isEnabledFor(logging.DEBUG):
+                for i, (doc, idx, score) in enumerate(zip(all_results, all_indices, all_scores)):
+                    file_source = self.file_sources.get(idx, "Unknown")
+                    logger.debug("Result %d from '%s' (score: %.4f): %.200s...", i + 1, file_source, score, doc)
             
-            return all_results
+            return [(self.file_sources.get(idx), doc) for doc, idx in zip(all_results, all_indices)]
         
         except Exception as e:
             logger.error(f"Error in transformer similarity search: {e}")
-            return ["Xin lỗi, đã xảy ra lỗi khi tìm kiếm thông tin liên quan."]
+            return [(None, "Xin lỗi, đã xảy ra lỗi khi tìm kiếm thông tin liên quan.")]
     
     def _determine_file_priorities(self, query):
         """
@@ -275,29 +561,21 @@ class TransformerVectorStore:
         
         try:
             # Encode the query
-            with torch.no_grad():
-                query_vector = self.model.encode([query], convert_to_numpy=True)
-            
-            # Get vectors for documents in this category
-            category_vectors = self.vectors[category_indices]
-            
-            # Calculate similarities
-            similarities = cosine_similarity(query_vector, category_vectors).flatten()
+            query_vector = self._embed(query)
             
-            # Sort by similarity
-            sorted_idx = np.argsort(similarities)[::-1]
+            # Calculate similarities against documents in this category
+            similarities = self._similarities(query_vector, category_indices)
             
-            # Collect results that meet the threshold
+            # Collect the top k results that meet the threshold
             results = []
             result_indices = []
             result_scores = []
             
-            for i in sorted_idx:
-                if similarities[i] >= threshold and len(results) < k:
-                    doc_idx = category_indices[i]
-                    results.append(self.documents[doc_idx])
-                    result_indices.append(doc_idx)
-                    result_scores.append(similarities[i])
+            for i in self._top_k(similarities, k, threshold):
+                doc_idx = category_indices[i]
+                results.append(self.documents[doc_idx])
+                result_indices.append(doc_idx)
+                result_scores.append(similarities[i])
             
             return results, result_indices, result_scores
             